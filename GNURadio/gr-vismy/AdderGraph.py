@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+#
+# SPDX-License-Identifier: GPL-3.0
+#
+# Project Title: Filter Coefficient Approximation using Sparse Assignment
+#
+
+from collections import Counter
+
+import numpy as np
+
+from ShiftAddFilter import ShiftAddFIR
+
+
+'''
+Multiple constant multiplication with common subexpression elimination.
+In a transposed-form filter every tap multiplies the same input sample, so
+the products of all the taps can share partial sums such as (x<<3) - x.
+
+The taps are written as lists of terms (node, shift, sign) over the nodes of
+an adder graph; node 0 is the input x. The most frequent pair of terms
+(same nodes, same relative shift and sign) across all the coefficients
+becomes a new node v = v_a + sign * (v_b << shift), and every occurrence of
+the pair is replaced by one term on the new node. This is repeated until no
+pair occurs twice (Hartley's method on the signed digit representation).
+Taps with the same magnitude (e.g. the two halves of a linear phase filter)
+share one product.
+───────────────────────────────────────────────────────────────────
+             nodes[K-1:1]: (a, b, shift, sign), v = v_a + sign * (v_b << shift)
+             products[U-1:0]: terms (node, shift, sign) of the distinct |taps|
+             tapProduct[NTAPS-1:0], tapSign[NTAPS-1:0]: product and sign of every tap
+───────────────────────────────────────────────────────────────────
+'''
+
+class AdderGraph(object):
+    '''!
+            Shared adder graph of the products of all the taps with the input
+    '''
+    def __init__(self, hDigits):
+        '''!
+        @param hDigits signed digit matrix of the taps (FIRfilterIntegerCoefficients.hDigits)
+        '''
+        hDigits = np.asarray(hDigits, dtype=np.int8)
+        ## Adder nodes (a, b, shift, sign); index 0 stands for the input
+        self.nodes = [None]
+        ## Terms (node, shift, sign) of every distinct tap magnitude
+        self.products = []
+        ## Product index of every tap, -1 for zero taps
+        self.tapProduct = np.full(len(hDigits), -1, dtype=np.int64)
+        ## Sign applied to the product of every tap
+        self.tapSign = np.zeros(len(hDigits), dtype=np.int64)
+        ## Additions of the multiplier block without sharing
+        self.naiveAdderCount = int(np.sum(np.maximum(np.count_nonzero(hDigits, axis=1) - 1, 0)))
+
+        index = {}
+        for t, row in enumerate(hDigits):
+            nz = np.flatnonzero(row)
+            if nz.size == 0:
+                continue
+            # products are shared up to the sign of the leading digit
+            sign = int(row[nz[-1]])
+            key = tuple((sign * row).tolist())
+            if key not in index:
+                index[key] = len(self.products)
+                self.products.append([(0, int(e), sign * int(row[e])) for e in nz])
+            self.tapProduct[t] = index[key]
+            self.tapSign[t] = sign
+        self.Eliminate()
+
+    @staticmethod
+    def PairKey(u, v):
+        '''!
+        @brief Pattern of two terms, independent of their common shift and sign
+
+        @return (pattern (a, b, shift, sign), shift of the occurrence, sign of the occurrence)
+        '''
+        if (u[1], u[0]) > (v[1], v[0]):
+            u, v = v, u
+        return (u[0], v[0], v[1] - u[1], u[2] * v[2]), u[1], u[2]
+
+    def Eliminate(self):
+        '''!
+        @brief Replace the most frequent pair of terms by a new adder node until no pair repeats
+        '''
+        # patterns whose occurrences overlap inside the coefficients and cannot be shared twice
+        rejected = set()
+        while True:
+            counts = Counter()
+            for terms in self.products:
+                for i in range(len(terms)):
+                    for j in range(i + 1, len(terms)):
+                        counts[self.PairKey(terms[i], terms[j])[0]] += 1
+            candidates = [kv for kv in counts.items() if kv[1] >= 2 and kv[0] not in rejected]
+            if not candidates:
+                return
+            pattern = max(candidates, key=lambda kv: (kv[1], -kv[0][2]))[0]
+            node = len(self.nodes)
+            products = [self.Replace(terms, pattern, node) for terms in self.products]
+            replaced = sum(t[0] == node for terms in products for t in terms)
+            if replaced < 2:
+                rejected.add(pattern)
+                continue
+            self.nodes.append(pattern)
+            self.products = products
+
+    def Replace(self, terms, pattern, node):
+        '''!
+        @brief Rewrite the non-overlapping occurrences of PATTERN in TERMS as terms on NODE
+        '''
+        remaining = list(terms)
+        rewritten = []
+        i = 0
+        while i < len(remaining):
+            for j in range(i + 1, len(remaining)):
+                key, shift, sign = self.PairKey(remaining[i], remaining[j])
+                if key == pattern:
+                    rewritten.append((node, shift, sign))
+                    del remaining[j], remaining[i]
+                    break
+            else:
+                i += 1
+        return rewritten + remaining
+
+    @property
+    def adderCount(self):
+        '''!
+        @brief Additions of the multiplier block with the shared subexpressions
+        '''
+        return len(self.nodes) - 1 + sum(max(len(terms) - 1, 0) for terms in self.products)
+
+    @property
+    def structuralAdderCount(self):
+        '''!
+        @brief Additions of the transposed-form delay line, identical with and without sharing
+        '''
+        return max(int(np.count_nonzero(self.tapProduct >= 0)) - 1, 0)
+
+    def values(self):
+        '''!
+        @brief Integer value of every node and of every tap, to check the graph against the taps
+        '''
+        nodeValues = [1]
+        for a, b, d, s in self.nodes[1:]:
+            nodeValues.append(nodeValues[a] + s * (nodeValues[b] << d))
+        productValues = [sum(s * (nodeValues[n] << e) for n, e, s in terms) for terms in self.products]
+        taps = [self.tapSign[t] * productValues[p] if p >= 0 else 0 for t, p in enumerate(self.tapProduct)]
+        return nodeValues, np.array(taps, dtype=np.int64)
+
+    def __str__(self):
+        return f'Adders: {self.naiveAdderCount} -> {self.adderCount} (+{self.structuralAdderCount} structural) | Nodes: {len(self.nodes) - 1} | Products: {len(self.products)}'
+
+
+class AdderGraphFIR(ShiftAddFIR):
+    '''!
+            ShiftAddFIR whose tap products are computed on a shared adder graph
+
+    The nodes of the graph are computed once per block of input. The terms
+    (node, shift, sign) of the products are then added in exponent order, as the
+    digits of ShiftAddFIR are: every node is shifted once per exponent into the
+    shift buffer and added at the delays of all the taps using it. The products
+    themselves are not materialized, since a product buffer costs one more vector
+    pass than it saves for a product used by one or two taps.
+    '''
+    def __init__(self, hRep, denominator):
+        super().__init__(hRep, denominator)
+        ## Adder graph of the tap products
+        self.graph = AdderGraph(self.hDigits)
+        ## Taps of every product: product -> (tap delays, signs)
+        self.productTaps = [
+            (np.flatnonzero(self.graph.tapProduct == p), self.graph.tapSign[self.graph.tapProduct == p])
+            for p in range(len(self.graph.products))
+        ]
+        delays = {}
+        for terms, (taps, signs) in zip(self.graph.products, self.productTaps):
+            for node, e, s in terms:
+                delays.setdefault((e, node), []).extend(zip(taps.tolist(), (s * signs).tolist()))
+        ## Product terms grouped by shift and node: [(shift, node, [(tap delay, sign)])]
+        self.nodeTerms = [(e, node, taps) for (e, node), taps in sorted(delays.items())]
+        self._nodes = None
+
+    @property
+    def numAdditions(self):
+        '''!
+        @brief Number of additions per output sample: shared multiplier block plus delay line
+        '''
+        return self.graph.adderCount + self.graph.structuralAdderCount
+
+    @property
+    def numVectorAdditions(self):
+        '''!
+        @brief Number of additions per output sample executed by ACCUMULATE: graph nodes plus product terms at their taps
+        '''
+        return len(self.graph.nodes) - 1 + sum(len(taps) for _, _, taps in self.nodeTerms) - 1
+
+    def nodeBuffers(self, shape, dtype):
+        '''!
+        @brief Buffers of the graph nodes for blocks of SHAPE (samples, channels...), allocated again only for larger blocks or another type
+        '''
+        nodes = self._nodes
+        if nodes is None or nodes.dtype != dtype or nodes.shape[1] < shape[0] or nodes.shape[2:] != shape[1:]:
+            self._nodes = np.empty((len(self.graph.nodes) - 1,) + tuple(shape), dtype=dtype)
+        return self._nodes
+
+    def accumulate(self, x, acc, xs=None):
+        '''!
+        @brief Add the delayed tap products of the integer input X into ACC, block by block
+
+        Trailing axes of X are channels filtered in the same pass, as in ShiftAddFIR.accumulate.
+
+        @param xs optional buffer of at least min(len(x), BLOCK_SIZE) samples for the shifted nodes
+        '''
+        if xs is None:
+            xs = np.empty((min(len(x), self.blockSize),) + x.shape[1:], dtype=acc.dtype)
+        nodes = self.nodeBuffers(xs.shape, acc.dtype)
+        for start in range(0, len(x), self.blockSize):
+            xb = x[start:start + self.blockSize]
+            n = len(xb)
+            window = acc[start:start + n + self.numTaps - 1]
+            shifted = xs[:n]
+            nodeValues = [xb] + [v[:n] for v in nodes]
+            for v, (a, b, d, s) in zip(nodeValues[1:], self.graph.nodes[1:]):
+                np.left_shift(nodeValues[b], d, out=shifted)
+                if s > 0:
+                    np.add(nodeValues[a], shifted, out=v)
+                else:
+                    np.subtract(nodeValues[a], shifted, out=v)
+            for e, node, taps in self.nodeTerms:
+                v = np.left_shift(nodeValues[node], e, out=shifted) if e else nodeValues[node]
+                for t, s in taps:
+                    if s > 0:
+                        window[t:t + n] += v
+                    else:
+                        window[t:t + n] -= v
+        return acc
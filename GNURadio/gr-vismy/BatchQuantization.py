@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+#
+# SPDX-License-Identifier: GPL-3.0
+#
+# Project Title: Filter Coefficient Approximation using Sparse Assignment
+#
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from FirTapsToInteger import FIRfilterIntegerCoefficients
+
+
+'''
+Quantization of whole filter banks (polyphase channelizers, families of
+decimators) across a process pool. The bank is cut into chunks of filters
+which are converted independently, so the results do not depend on the
+number of workers, and they are returned in the order of the input.
+'''
+
+def _QuantizeChunk(args):
+    maxBitSetSize, maxBitWidth, errorTarget, chunk = args
+    convertor = FIRfilterIntegerCoefficients(maxBitSetSize=maxBitSetSize, maxBitWidth=maxBitWidth, errorTarget=errorTarget)
+    return [convertor(hFIR) for hFIR in chunk]
+
+
+def BatchQuantize(filterBank, maxBitSetSize:int=2, maxBitWidth:int=20, workers:int=None, chunkSize:int=None, errorTarget:float=None):
+    """!
+    @brief Convert every filter of a bank to its integer representation with FIRfilterIntegerCoefficients
+
+    @param filterBank list of tap arrays, or 2-D array with one filter per row
+    @param maxBitSetSize Number of elements in the sparse set
+    @param maxBitWidth Total bit width of the coefficient representation
+    @param workers Number of worker processes; None uses every core, 1 runs in the calling process
+    @param chunkSize Number of filters sent to a worker at a time; None gives every worker about four chunks
+    @param errorTarget Optional tap error target; every filter then gets its own smallest bit width (see FIRfilterIntegerCoefficients)
+    @return list of [hTruncated, denominator] in the order of FILTER_BANK
+    """
+    filters = [np.asarray(hFIR, dtype=np.float64) for hFIR in filterBank]
+    if not filters:
+        return []
+    workers = min(workers or os.cpu_count() or 1, len(filters))
+    if chunkSize is None:
+        chunkSize = -(-len(filters) // (4 * workers))
+    chunks = [
+        (maxBitSetSize, maxBitWidth, errorTarget, filters[i:i + chunkSize])
+        for i in range(0, len(filters), chunkSize)
+    ]
+    if workers == 1:
+        results = map(_QuantizeChunk, chunks)
+        return [r for chunk in results for r in chunk]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # map yields the chunks in submission order whatever the completion order
+        results = pool.map(_QuantizeChunk, chunks)
+        return [r for chunk in results for r in chunk]
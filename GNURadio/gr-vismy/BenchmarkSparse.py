@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+#
+# SPDX-License-Identifier: GPL-3.0
+#
+# Project Title: Filter Coefficient Approximation using Sparse Assignment
+#
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+
+import numpy as np
+
+from FirTapsToInteger import FIRfilterIntegerCoefficients
+from RepresentationCache import GetRepresentationCache
+from SparseAllocation import HeapGreedyAllocation, HybridSparseAllocation, UniformSparseAllocation
+from TransportOptimization import NonUniformSparseAssignment, OptimalSparseAssignment, MinSubsetNearTargetSum
+
+
+'''
+Benchmark harness of the sparse assignment algorithms. Low-pass and band-pass
+filters of a range of lengths are quantized at a range of bit widths and every
+method is run on them; wall time, peak traced memory, total cost and number
+of calls are written to a JSON file together with the git revision, so that
+runs of different commits can be compared.
+───────────────────────────────────────────────────────────────────
+             convert: FIRfilterIntegerCoefficients (MAX_BIT_SET_SIZE = 2) on the non-zero taps
+             subset: MinSubsetNearTargetSum on the first SUBSET_TAPS taps
+             bnb: the same search with branch-and-bound pruning
+             nusa/unsa/hysa: allocators of SparseAllocation
+             osa: knapsack reference of OptimalSparseAssignment
+───────────────────────────────────────────────────────────────────
+The shared representation cache is cleared before every run; the signed
+power-of-two tables themselves stay built, as they do in a design session.
+'''
+
+METHODS = ('convert', 'subset', 'bnb', 'nusa', 'unsa', 'hysa', 'osa')
+
+def BenchmarkFilters(numTaps, bandPass=False):
+    '''!
+    @brief Hamming windowed firdes design with about NUM_TAPS taps (sampling rate 1)
+    '''
+    from gnuradio.filter import firdes as fir
+
+    # firdes sizes the Hamming window as 53 dB * fs / (22 * transition width)
+    transition = 53 / (22 * max(numTaps - 1, 1))
+    if bandPass:
+        return np.array(fir.band_pass(1, 1, 0.1, 0.3, transition))
+    return np.array(fir.low_pass(1, 1, 0.2, transition))
+
+
+def Measure(fn, repeat=1):
+    '''!
+    @brief Run FN REPEAT times from a cleared cache
+
+    @return (result of the last run, smallest wall time in s, largest traced peak memory in bytes)
+    '''
+    wall, peak = np.inf, 0
+    for _ in range(repeat):
+        GetRepresentationCache().clear()
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = fn()
+        wall = min(wall, time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return result, wall, peak
+
+
+def GitRevision():
+    '''!
+    @brief Commit hash of the working tree, None outside of a git checkout
+    '''
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def RunMethod(method, hFIR, hInteger, numBits, sparseBudget, kmax, subsetTaps):
+    '''!
+    @brief Run one method on one filter
+
+    @return (total cost, number of calls)
+    '''
+    if method == 'convert':
+        # convertTapsToInteger sizes the width on the smallest tap, so the taps which round to zero are left out
+        hNonZero = hInteger[hInteger != 0] * 2.0**-numBits
+        convertor = FIRfilterIntegerCoefficients(maxBitSetSize=2, maxBitWidth=numBits)
+        hTruncated, _ = convertor(hNonZero)
+        hRef, _ = convertor.convertTapsToInteger(hNonZero, maxBitWidth=numBits)
+        return float(np.sum(np.abs(hRef - np.array(hTruncated)))), len(hNonZero)
+    if method in ('subset', 'bnb'):
+        searchSet = [2**i for i in range(numBits + 1)] + [-(2**i) for i in range(numBits + 1)]
+        vals = hInteger[:subsetTaps]
+        search = 'branch' if method == 'bnb' else 'exhaustive'
+        subsets = [MinSubsetNearTargetSum(searchSet, len(searchSet), val, 2, method=search) for val in vals]
+        return float(sum(abs(val - sum(subset)) for val, subset in zip(vals, subsets))), len(vals)
+    if method == 'nusa':
+        taps = [NonUniformSparseAssignment(i, el) for i, el in enumerate(hInteger)]
+        result = HeapGreedyAllocation(taps, sparseBudget, numBits=numBits, kmax=kmax)
+    elif method == 'unsa':
+        result = UniformSparseAllocation(hInteger, sparseBudget, numBits=numBits, kmax=kmax)
+    elif method == 'hysa':
+        result = HybridSparseAllocation(hInteger, sparseBudget, numBits=numBits, kmax=kmax)
+    elif method == 'osa':
+        osa = OptimalSparseAssignment(hInteger)
+        osa(sparseBudget, numBits=numBits, kmax=kmax)
+        return osa.totalCost, osa.numCalls
+    else:
+        raise ValueError(f'Unknown method: {method}')
+    return result.totalCost, result.numCalls
+
+
+def RunBenchmark(tapList, bitWidths, methods=METHODS, budgetPerTap=2, kmax=4, subsetTaps=32, repeat=1):
+    '''!
+    @brief Every method on the low-pass and band-pass filters of every length and bit width
+
+    @param tapList filter lengths
+    @param bitWidths bit widths of the integer coefficients (numBits of the search set)
+    @param methods subset of METHODS
+    @param budgetPerTap sparse budget of a filter per tap
+    @param kmax largest number of assignments of a tap; bounds the signed power-of-two tables at wide bit widths
+    @param subsetTaps number of taps searched exhaustively by the 'subset' method
+    @param repeat runs per measurement, the fastest is kept
+    @return list of records, one per filter and method
+    '''
+    records = []
+    for bandPass in (False, True):
+        for numTaps in tapList:
+            hFIR = BenchmarkFilters(numTaps, bandPass)
+            for numBits in bitWidths:
+                hInteger = np.round(hFIR / 2**-numBits)
+                sparseBudget = int(budgetPerTap * len(hFIR))
+                for method in methods:
+                    record = {
+                        'filter': 'band_pass' if bandPass else 'low_pass',
+                        'taps': len(hFIR),
+                        'bits': numBits,
+                        'budget': sparseBudget,
+                        'method': method,
+                    }
+                    try:
+                        (cost, calls), wall, peak = Measure(
+                            lambda: RunMethod(method, hFIR, hInteger, numBits, sparseBudget, kmax, subsetTaps), repeat
+                        )
+                        record.update(time=wall, peakMemory=peak, totalCost=cost, numCalls=calls)
+                    except ValueError as err:
+                        record.update(error=str(err))
+                    records.append(record)
+                    print(' '.join(f'{k}={v}' for k, v in record.items()))
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the sparse assignment algorithms')
+    parser.add_argument('--taps', type=int, nargs='+', default=[16, 64, 256, 1024])
+    parser.add_argument('--bits', type=int, nargs='+', default=[8, 12, 16, 20, 24])
+    parser.add_argument('--methods', nargs='+', choices=METHODS, default=list(METHODS))
+    parser.add_argument('--budget-per-tap', type=float, default=2)
+    parser.add_argument('--kmax', type=int, default=4)
+    parser.add_argument('--subset-taps', type=int, default=32)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args()
+
+    records = RunBenchmark(
+        args.taps, args.bits, methods=args.methods, budgetPerTap=args.budget_per_tap,
+        kmax=args.kmax, subsetTaps=args.subset_taps, repeat=args.repeat,
+    )
+    report = {
+        'git': GitRevision(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'parameters': vars(args),
+        'results': records,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f'Results written to {args.output}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+#
+# SPDX-License-Identifier: GPL-3.0
+#
+# Project Title: Filter Coefficient Approximation using Sparse Assignment
+#
+
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+from FirTapsToInteger import FIRfilterIntegerCoefficients
+from Instrumentation import GetMetrics
+from ShiftAddFilter import TermsToSignedDigits
+from SparseAllocation import AllocationResult
+
+
+'''
+Content addressed on-disk cache of finished designs. A design is keyed by the
+sha256 of the tap array (dtype, shape and bytes) and of the parameters of the
+quantizer or allocator which produced it, so the same firdes taps quantized
+with the same parameters are read back instead of being designed again.
+
+Every design is a directory of .npy files, loaded memory-mapped, and a small
+meta.json with the scalars:
+───────────────────────────────────────────────────────────────────
+             CACHE_DIR/ab/abcdef.../
+                 hInteger.npy: integer taps
+                 hDigits.npy: int8 signed digit matrix of the representations
+                 assgn.npy, hApp.npy, cost.npy: allocations only
+                 budgetCost.npy: allocations recording the cost after every budget unit
+                 meta.json: denominator, parameters, number of calls, response error
+───────────────────────────────────────────────────────────────────
+A design is written to a private temporary directory and renamed into place.
+The rename is atomic, so a reader sees either no design or a complete one;
+when two writers race, the first rename wins and the other copy is dropped.
+'''
+
+## Version of the on-disk layout, part of every key
+FORMAT_VERSION = 2
+
+## Allocator parameters which change how a design is computed but not the design, left out of the key
+NON_SEMANTIC_PARAMS = ('cache',)
+
+def _JsonParam(value):
+    '''!
+    @brief JSON value of the NumPy scalars and arrays among the parameters; any other object is rejected
+    '''
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    raise TypeError(f'design parameter of type {type(value).__name__} is not JSON serializable and cannot be part of a key')
+
+def DesignKey(hFIR, **params):
+    '''!
+    @brief sha256 hex digest of the taps HFIR and of the parameters PARAMS of the design
+
+    The parameters must be JSON serializable (NumPy scalars and arrays included), so that the
+    key only depends on their values; a TypeError is raised for any other object.
+    '''
+    h = np.ascontiguousarray(hFIR, dtype=np.float64)
+    digest = hashlib.sha256()
+    digest.update(f'{FORMAT_VERSION}|{h.dtype.str}|{h.shape}|'.encode())
+    digest.update(h.tobytes())
+    digest.update(json.dumps(params, sort_keys=True, default=_JsonParam).encode())
+    return digest.hexdigest()
+
+
+class DesignCache(object):
+    '''!
+            Directory of finished designs addressed by DesignKey
+    '''
+    def __init__(self, cacheDir):
+        ## Root directory of the cache
+        self.cacheDir = cacheDir
+        ## Number of designs read from the cache
+        self.hits = 0
+        ## Number of designs built and written
+        self.misses = 0
+
+    def path(self, key):
+        return os.path.join(self.cacheDir, key[:2], key)
+
+    def load(self, key):
+        '''!
+        @brief Arrays (memory-mapped) and meta data of the design KEY, None when it is not cached
+
+        @return (dict of arrays, meta dict) or None
+        '''
+        path = self.path(key)
+        try:
+            with open(os.path.join(path, 'meta.json')) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in meta['arrays']}
+        return arrays, meta
+
+    def store(self, key, arrays, meta):
+        '''!
+        @brief Write the design KEY atomically; an existing design of the same key is kept
+        '''
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmpPath = f'{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp'
+        os.makedirs(tmpPath)
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmpPath, f'{name}.npy'), np.asarray(array))
+            with open(os.path.join(tmpPath, 'meta.json'), 'w') as f:
+                json.dump(dict(meta, arrays=sorted(arrays)), f)
+            os.rename(tmpPath, path)
+        except OSError:
+            # another writer renamed its copy of the same design first
+            if not os.path.isdir(path):
+                raise
+        finally:
+            shutil.rmtree(tmpPath, ignore_errors=True)
+
+    def _fetch(self, key):
+        entry = self.load(key)
+        metrics = GetMetrics()
+        if entry is None:
+            self.misses += 1
+            metrics.count('designCacheMisses')
+        else:
+            self.hits += 1
+            metrics.count('designCacheHits')
+        return entry
+
+    def quantize(self, hFIR, maxBitSetSize=2, maxBitWidth=20, errorTarget=None):
+        '''!
+        @brief FIRfilterIntegerCoefficients(maxBitSetSize, maxBitWidth, errorTarget=errorTarget)(hFIR) through the cache
+
+        @return ([hTruncated, denominator], hDigits) with hDigits the signed digit matrix of the taps
+        '''
+        params = {'design': 'quantize', 'maxBitSetSize': maxBitSetSize, 'maxBitWidth': maxBitWidth, 'errorTarget': errorTarget}
+        key = DesignKey(hFIR, **params)
+        entry = self._fetch(key)
+        if entry is None:
+            convertor = FIRfilterIntegerCoefficients(maxBitSetSize=maxBitSetSize, maxBitWidth=maxBitWidth, errorTarget=errorTarget)
+            hTruncated, denominator = convertor(hFIR)
+            arrays = {'hInteger': np.array(hTruncated, dtype=np.int64), 'hDigits': convertor.hDigits}
+            self.store(key, arrays, dict(params, denominator=float(denominator)))
+            return [hTruncated, denominator], convertor.hDigits
+        arrays, meta = entry
+        return [arrays['hInteger'].tolist(), meta['denominator']], arrays['hDigits']
+
+    def allocate(self, allocator, hCoeffs, sparseBudget, **params):
+        '''!
+        @brief ALLOCATOR(hCoeffs, sparseBudget, **params) through the cache
+
+        The NON_SEMANTIC_PARAMS, such as a shared SparseRepresentationCache, are passed to the
+        allocator but are not part of the key. budgetCost and responseError are stored with the design.
+
+        @param allocator allocation function of SparseAllocation, e.g. HybridSparseAllocation
+        @return AllocationResult
+        '''
+        keyParams = {name: value for name, value in params.items() if name not in NON_SEMANTIC_PARAMS}
+        keyParams.update(design=allocator.__name__, sparseBudget=sparseBudget)
+        key = DesignKey(hCoeffs, **keyParams)
+        entry = self._fetch(key)
+        if entry is None:
+            result = allocator(hCoeffs, sparseBudget, **params)
+            arrays = {
+                'assgn': result.assgn, 'hApp': result.hApp, 'cost': result.cost,
+                'hDigits': TermsToSignedDigits(result.hRep),
+            }
+            if result.budgetCost is not None:
+                arrays['budgetCost'] = result.budgetCost
+            responseError = None if result.responseError is None else float(result.responseError)
+            self.store(key, arrays, dict(
+                keyParams, numCalls=int(result.numCalls), numExchanges=int(result.numExchanges), responseError=responseError,
+            ))
+            return result
+        arrays, meta = entry
+        result = AllocationResult(
+            arrays['assgn'], arrays['hApp'], arrays['cost'],
+            hRep=FIRfilterIntegerCoefficients.SignedDigitsToSubsets(arrays['hDigits']),
+            numCalls=meta['numCalls'],
+        )
+        result.numExchanges = meta['numExchanges']
+        result.budgetCost = arrays.get('budgetCost')
+        result.responseError = meta['responseError']
+        return result
+
+    def clear(self):
+        shutil.rmtree(self.cacheDir, ignore_errors=True)
+        self.hits = 0
+        self.misses = 0
@@ -1,10 +1,15 @@
 #!/usr/bin/env python
 
 import itertools as it
+import logging
 
 import numpy as np
-from gnuradio.filter import firdes as fir
-from loguru import logger
+
+from Instrumentation import GetMetrics
+from SignedPowerTable import MasksToSignedDigits
+
+# the quantizer core depends on NumPy only; gnuradio and loguru are imported by the demo in main()
+log = logging.getLogger(__name__)
 
 
 class FIRfilterIntegerCoefficients(object):
@@ -12,19 +17,25 @@ class FIRfilterIntegerCoefficients(object):
     @brief The purpose of this class is to convert the real values in FIR filter to integer quantized representation with at most MAX_BIT_SET_SIZE bits. That is, every real-valued coefficient is converted to its sparse form with atmost MAX_BIT_SET_SIZE. For example, if  MAX_BIT_SET_SIZE=2 the integer representation is an addition (or subtraction) of two integers which are powers of 2.
     """
 
-    def __init__(self, maxBitSetSize:int =2, maxBitWidth:int=20)-> None:
+    def __init__(self, maxBitSetSize:int =2, maxBitWidth:int=20, cache=None, errorTarget:float=None)-> None:
         """!
         @brief Filter converter initializer
 
         @param maxBitSetSize Number of elements in the sparse set
         @param maxBitWidth Total bit width of the coefficient representation
+        @param cache Optional SparseRepresentationCache; the taps then take the closest MAX_BIT_SET_SIZE term representation from the shared cache instead of the truncated canonical signed digits
+        @param errorTarget Optional bound on the largest tap error relative to the largest tap; the bit width is then the smallest one meeting it (SearchBitWidth) instead of the log2 of the smallest tap
         """
-        self.maxBitSetSize = maxBitSetSize
+        self._maxBitSetSize = maxBitSetSize
         self.maxBitWidth = maxBitWidth
+        self.cache = cache
+        self.errorTarget = errorTarget
+        ## Bit width and number of set bits per tap of the last conversion
+        self.bitWidth, self.bitSetSize = None, None
     
     @property
     def maxBitSetSize(self):
-        return self.maxBitSetSize
+        return self._maxBitSetSize
     
     @staticmethod
     def convertTapsToInteger(hFIR, maxBitWidth:int=20):
@@ -45,28 +56,164 @@ class FIRfilterIntegerCoefficients(object):
 
         @param hFIR List/Array of FIR filter coefficients
         """
-        h, requireWidth = self.convertTapsToInteger(hFIR, maxBitWidth=self.maxBitWidth) 
-        numBits = int(requireWidth)
+        if self.errorTarget is None:
+            h, requireWidth = self.convertTapsToInteger(hFIR, maxBitWidth=self.maxBitWidth)
+            numBits, bitSetSize = int(requireWidth), self.maxBitSetSize
+        else:
+            numBits, bitSetSize = self.SearchBitWidth(hFIR, self.errorTarget)
+            h = np.round(np.asarray(hFIR, dtype=np.float64) / 2.0**-numBits)
+        self.bitWidth, self.bitSetSize = numBits, bitSetSize
 
-        self.searchSet = searchSet = [2**i for i in range(numBits + 1)] + [
+        self.searchSet = [2**i for i in range(numBits + 1)] + [
             -(2**i) for i in range(numBits + 1)
         ]
 
-        hTruncated = []
-
-        for el in h:
-            s = self.MinSubsetOfTargetSum(
-                searchSet, 2 * (numBits + 1), el, self.maxBitSetSize
-            )
-            print(s)
-            hTruncated.append(sum(s))  # sparse quantized coefficient
+        # signed digit matrix: column i holds the sign of the 2^i shift of every tap
+        self.hDigits = self.sparseDigits(h, numBits, bitSetSize)
+        hTruncated = self.SignedDigitsToInteger(self.hDigits).tolist()  # sparse quantized coefficients
 
         denominator = np.sum(hTruncated)
         denominatorShift = np.round(np.log2(abs(denominator)))
-        logger.info(f"Denominator Shift={denominatorShift}")
-        # TODO: return an integer array with the index location of the sparse factors
+        log.debug('Denominator Shift=%s', denominatorShift)
+        metrics = GetMetrics()
+        if metrics.enabled:
+            metrics.count('filtersConverted')
+            metrics.count('tapsConverted', len(hTruncated))
         return [hTruncated, np.sign(denominator) * 2**denominatorShift]
 
+    def sparseDigits(self, h, numBits:int, maxBitSetSize:int):
+        """!
+        @brief Signed digit matrix of the integer taps H with at most MAX_BIT_SET_SIZE digits per tap
+
+        The canonical signed digits of every tap which has at most MAX_BIT_SET_SIZE of them, the closest value with MAX_BIT_SET_SIZE terms otherwise (from the cache when there is one)
+        """
+        if self.cache is not None:
+            pos, neg = self.cache.masks(h, maxBitSetSize, numBits)
+            return MasksToSignedDigits(pos, neg, numBits + 2)
+        h = np.rint(np.asarray(h, dtype=np.float64)).astype(np.int64).reshape(-1)
+        digits = self.CanonicalSignedDigits(h, numBits)
+        over = np.count_nonzero(digits, axis=1) > maxBitSetSize
+        if not np.any(over):
+            return digits
+        # the taps which need more digits take the closest value with MAX_BIT_SET_SIZE terms,
+        # whose canonical form has at most that many digits
+        h[over] = self.NearestSparseInteger(h[over], numBits, maxBitSetSize)
+        return self.CanonicalSignedDigits(h, numBits)
+
+    def tapError(self, hFIR, numBits:int, maxBitSetSize:int):
+        """!
+        @brief Largest tap error of the conversion at NUM_BITS bits, relative to the largest tap
+
+        @return max |hFIR - hTruncated 2^-numBits| / max |hFIR|
+        """
+        hFIR = np.asarray(hFIR, dtype=np.float64)
+        h = np.round(hFIR / 2.0**-numBits)
+        hApp = self.SignedDigitsToInteger(self.sparseDigits(h, numBits, maxBitSetSize)) * 2.0**-numBits
+        return float(np.max(np.abs(hFIR - hApp)) / np.max(np.abs(hFIR)))
+
+    def SearchBitWidth(self, hFIR, errorTarget:float):
+        """!
+        @brief Smallest bit width, then smallest number of set bits per tap, whose tap error meets ERROR_TARGET
+
+        The tap error does not always decrease with the width: the taps are rounded to the width before
+        they are approximated, so the error can grow from one width to the next. The widths 0 .. maxBitWidth
+        are therefore scanned in order, each one a single vectorized conversion of all the taps; tiny tail
+        taps simply round to zero instead of forcing the width to log2 of the smallest tap.
+
+        @param hFIR List/Array of FIR filter coefficients
+        @param errorTarget bound on max |hFIR - hTruncated 2^-width| / max |hFIR|
+        @return (width, maxBitSetSize)
+        """
+        metrics = GetMetrics()
+        for width in range(self.maxBitWidth + 1):
+            metrics.count('widthEvaluations')
+            if self.tapError(hFIR, width, self.maxBitSetSize) <= errorTarget:
+                break
+        else:
+            raise ValueError("No Fixed Point Width up to Max Width meets the Error Target")
+        bitSetSize = next(
+            k for k in range(1, self.maxBitSetSize + 1) if self.tapError(hFIR, width, k) <= errorTarget
+        )
+        return width, bitSetSize
+
+    @staticmethod
+    def CanonicalSignedDigits(h, numBits:int):
+        """!
+        @brief Encode integer coefficients in canonical signed digit (non-adjacent) form
+
+        The non-adjacent form writes every integer as sum d[i] 2^i with d[i] in {-1, 0, 1} and no two adjacent non-zero digits. It has the minimal number of non-zero digits among all signed power-of-two representations, i.e. it is the subset that MinSubsetOfTargetSum searches for. The encoder runs once per bit position and is vectorized over all the taps.
+
+        @param h List/Array of integer filter coefficients
+        @param numBits Largest shift of the search space
+        @return int8 matrix with one row per coefficient and the signed digit of 2^i in column i
+        """
+        x = np.rint(np.asarray(h, dtype=np.float64)).astype(np.int64).reshape(-1)
+        sign = np.sign(x).astype(np.int8)
+        x = np.abs(x)
+        # one extra column for the carry of the top digit
+        width = max(numBits + 1, int(np.max(x, initial=0)).bit_length()) + 1
+        digits = np.zeros((x.size, width), dtype=np.int8)
+        for i in range(width):
+            d = np.where(x & 1, 2 - (x & 3), 0)
+            digits[:, i] = d
+            x = (x - d) >> 1
+        return digits * sign[:, None]
+
+    @staticmethod
+    def NearestSparseInteger(h, numBits:int, maxBitSetSize:int):
+        """!
+        @brief Closest value to every integer of H which is a sum of at most MAX_BIT_SET_SIZE terms +/-2^i, i <= numBits
+
+        The terms are chosen from the largest down: each one is the power of two just below or just above the magnitude of the residual, so the 2^MAX_BIT_SET_SIZE candidates of every tap are searched in one vectorized pass. It gives the cost of the exhaustive search (SignedPowerTable.nearest), without the table of all the sums, which does not fit in memory at wide bit widths and many terms.
+
+        @param h List/Array of integer filter coefficients
+        @param numBits Largest shift of the search space
+        @param maxBitSetSize the sparsity requirement of every coefficient
+        @return int64 array of the approximations
+        """
+        x = np.rint(np.asarray(h, dtype=np.float64)).astype(np.int64).reshape(-1)
+        candidates = np.zeros((x.size, 1), dtype=np.int64)
+        for _ in range(maxBitSetSize):
+            residual = x[:, None] - candidates
+            mag = np.abs(residual)
+            e = np.minimum(np.floor(np.log2(np.maximum(mag, 1))).astype(np.int64), numBits)
+            sign = np.sign(residual)
+            below = sign * np.left_shift(np.int64(1), e)
+            above = sign * np.left_shift(np.int64(1), np.minimum(e + 1, numBits))
+            candidates = np.concatenate([candidates + below, candidates + above], axis=1)
+        best = np.argmin(np.abs(x[:, None] - candidates), axis=1)
+        return candidates[np.arange(x.size), best]
+
+    @staticmethod
+    def TruncateSignedDigits(digits, maxBitSetSize:int):
+        """!
+        @brief Restrict every row of a signed digit matrix to its MAX_BIT_SET_SIZE most significant non-zero digits
+
+        @param digits Signed digit matrix from CanonicalSignedDigits
+        @param maxBitSetSize the sparsity requirement of every coefficient
+        """
+        rank = np.cumsum((digits != 0)[:, ::-1], axis=1)[:, ::-1]
+        return np.where(rank <= maxBitSetSize, digits, 0).astype(np.int8)
+
+    @staticmethod
+    def SignedDigitsToInteger(digits):
+        """!
+        @brief Integer value of every row of a signed digit matrix
+        """
+        return digits.astype(np.int64) @ (np.int64(1) << np.arange(digits.shape[1], dtype=np.int64))
+
+    @staticmethod
+    def SignedDigitsToSubsets(digits):
+        """!
+        @brief Convert a signed digit matrix to the list of +/-2^i terms of every coefficient, in the order of the search set used by MinSubsetOfTargetSum
+        """
+        subsets = []
+        for row in digits:
+            pos = [2**int(i) for i in np.flatnonzero(row > 0)]
+            neg = [-(2**int(i)) for i in np.flatnonzero(row < 0)]
+            subsets.append(pos + neg)
+        return subsets
+
     @staticmethod
     def ErrorVectorMetric(h:list[int], hHat:list[int]):
         assert len(h) == len(
@@ -79,12 +226,15 @@ class FIRfilterIntegerCoefficients(object):
         """
         Core logic to find the best subset representing the value VAL
 
+        Exhaustive reference search; __call__ uses the equivalent CanonicalSignedDigits encoder
+
         @param set list which is the search space for the sparse representation
         @param n the size of the search space list
         @param val the value of the integer to be converted
         @param maxBitSetSize the sparsity requirement of the value
         """
         count = 0
+        candidates = 0
         minSubSet = []
         sizeSSET = n
         # identify the shift combinations in the sparse form
@@ -92,6 +242,7 @@ class FIRfilterIntegerCoefficients(object):
             foundFlag = 0
             sparseSet = it.combinations(range(n), i)
             for bits in sparseSet:
+                candidates += 1
                 subSet = [set[i] for i in bits]
                 if sum(subSet) == val:
                     count += 1
@@ -101,9 +252,13 @@ class FIRfilterIntegerCoefficients(object):
             if foundFlag == 1:
                 break
 
+        metrics = GetMetrics()
+        if metrics.enabled:
+            metrics.count('subsetSearches')
+            metrics.count('candidatesEvaluated', candidates)
         # it means no subset is found with given sum
         if count == 0:
-            print("No subset is found")
+            metrics.count('subsetNotFound')
 
         else:
             # print(np.sum(minSubSet), "-> \t", end="")
@@ -121,6 +276,9 @@ class FIRfilterIntegerCoefficients(object):
 
 
 def main():
+    from gnuradio.filter import firdes as fir
+    from loguru import logger
+
     g = 1
     t = 20
     fs = 250
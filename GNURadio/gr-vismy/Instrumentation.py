@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+#
+# SPDX-License-Identifier: GPL-3.0
+#
+# Project Title: Filter Coefficient Approximation using Sparse Assignment
+#
+
+import io
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+
+'''
+Instrumentation of the design algorithms: named counters (search calls,
+candidates evaluated, cache hits, exchange moves, ...) and timers, collected
+by a process wide Metrics object. It is disabled by default; the call sites
+test the ENABLED flag before counting, so a disabled run pays one attribute
+lookup per call site and does no console I/O.
+
+A design run is instrumented with
+    with GetMetrics().run('hysa', profile=True) as report:
+        HybridSparseAllocation(...)
+    report.counters, report.timers, report.profile
+Callbacks subscribed to the Metrics object receive every counter increment
+and timer measurement as (name, value) while it is enabled, and every report
+at the end of a run as ('run', report).
+'''
+
+class RunReport(object):
+    '''!
+            Counters, timers and optional profile of one instrumented design run
+    '''
+    def __init__(self, name):
+        ## Name of the run
+        self.name = name
+        ## Counter name -> total
+        self.counters = {}
+        ## Timer name -> (total seconds, number of measurements)
+        self.timers = {}
+        ## Wall time of the run in seconds
+        self.wallTime = 0.0
+        ## pstats.Stats of the run when it was profiled
+        self.profile = None
+
+    def profileSummary(self, limit=20, sortKey='cumulative'):
+        '''!
+        @brief Text of the LIMIT most expensive functions of the profile, '' when the run was not profiled
+        '''
+        if self.profile is None:
+            return ''
+        stream = io.StringIO()
+        self.profile.stream = stream
+        self.profile.sort_stats(sortKey).print_stats(limit)
+        return stream.getvalue()
+
+    def asdict(self):
+        return {'name': self.name, 'wallTime': self.wallTime, 'counters': self.counters,
+                'timers': {k: {'time': t, 'count': n} for k, (t, n) in self.timers.items()}}
+
+    def __str__(self):
+        counters = ' | '.join(f'{k}: {v}' for k, v in sorted(self.counters.items()))
+        timers = ' | '.join(f'{k}: {t:.6f} s / {n}' for k, (t, n) in sorted(self.timers.items()))
+        return f'Run {self.name}: {self.wallTime:.6f} s --- {counters} --- {timers}'
+
+
+class Metrics(object):
+    '''!
+            Process wide counters and timers of the design algorithms, disabled by default
+    '''
+    def __init__(self):
+        ## Counting is skipped by the call sites while False
+        self.enabled = False
+        ## Counter name -> total
+        self.counters = Counter()
+        ## Timer name -> [total seconds, number of measurements]
+        self.timers = {}
+        self._callbacks = []
+
+    def count(self, name, value=1):
+        '''!
+        @brief Add VALUE to the counter NAME
+        '''
+        if not self.enabled:
+            return
+        self.counters[name] += value
+        for callback in self._callbacks:
+            callback(name, value)
+
+    def timer(self, name):
+        '''!
+        @brief Context manager adding the wall time of its block to the timer NAME
+        '''
+        if not self.enabled:
+            return nullcontext()
+        return self._timer(name)
+
+    @contextmanager
+    def _timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            entry = self.timers.setdefault(name, [0.0, 0])
+            entry[0] += elapsed
+            entry[1] += 1
+            for callback in self._callbacks:
+                callback(name, elapsed)
+
+    def subscribe(self, callback):
+        '''!
+        @brief Call CALLBACK(name, value) on every counter increment and timer measurement
+        '''
+        self._callbacks.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        self._callbacks.remove(callback)
+
+    def reset(self):
+        self.counters.clear()
+        self.timers.clear()
+
+    @contextmanager
+    def run(self, name='design', profile=False):
+        '''!
+        @brief Instrument the block of a design run from zeroed counters and yield its RunReport
+
+        The report is filled when the block exits; the previous state of the metrics is restored.
+
+        @param name name of the run
+        @param profile run the block under cProfile and keep the statistics in report.profile
+        '''
+        report = RunReport(name)
+        saved = (self.enabled, self.counters, self.timers)
+        self.enabled, self.counters, self.timers = True, Counter(), {}
+        profiler = None
+        if profile:
+            import cProfile
+            profiler = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            if profiler is not None:
+                profiler.enable()
+            yield report
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                import pstats
+                report.profile = pstats.Stats(profiler)
+            report.wallTime = time.perf_counter() - start
+            report.counters = dict(self.counters)
+            report.timers = {k: tuple(v) for k, v in self.timers.items()}
+            self.enabled, self.counters, self.timers = saved
+            for callback in self._callbacks:
+                callback('run', report)
+
+
+## Metrics shared by every module of the process
+_sharedMetrics = Metrics()
+
+def GetMetrics():
+    '''!
+    @brief Process wide Metrics object
+    '''
+    return _sharedMetrics
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+#
+# SPDX-License-Identifier: GPL-3.0
+#
+# Project Title: Filter Coefficient Approximation using Sparse Assignment
+#
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from Instrumentation import GetMetrics
+from SignedPowerTable import GetSignedPowerTable, MasksToExponents, MasksToTerms
+
+
+'''
+Shared cache of sparse representations. Filters of a design sweep share their
+integer coefficients and numBits, so the best approximation of a value with
+at most k signed power-of-two terms is looked up rather than searched again.
+
+Two levels are used:
+    a. an in-process LRU of (value, k, numBits) -> (representation, cost)
+       bounded by MAX_ENTRIES
+    b. optionally, a dense table of the best representation of every integer
+       0 .. 2^numBits for each k, stored as .npy files in TABLE_DIR and
+       memory-mapped, so that only the pages which are used are read
+The dense table falls back to the binary search of SignedPowerTable for
+values outside of its range, and when no TABLE_DIR is given.
+'''
+
+class SparseRepresentationCache(object):
+    '''!
+            Cache of the best k-term signed power-of-two representation of integer values
+    '''
+    def __init__(self, maxEntries=1 << 16, tableDir=None):
+        ## Bound on the number of (value, k, numBits) entries kept in memory
+        self.maxEntries = maxEntries
+        ## Directory of the memory-mapped dense tables; None keeps the cache in memory only
+        self.tableDir = tableDir
+        ## Number of lookups answered from the LRU
+        self.hits = 0
+        ## Number of lookups which required a table access
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._denseTables = {}
+
+    def lookup(self, val, maxBitSetSize, numBits=6):
+        '''!
+        @brief Best representation of VAL with at most MAX_BIT_SET_SIZE terms +/-2^i, i <= numBits
+
+        @return (list of the signed power-of-two terms, absolute cost)
+        '''
+        key = (float(val), int(maxBitSetSize), int(numBits))
+        entry = self._entries.get(key)
+        metrics = GetMetrics()
+        if metrics.enabled:
+            metrics.count('cacheHits' if entry is not None else 'cacheMisses')
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return list(entry[0]), entry[1]
+        self.misses += 1
+        if maxBitSetSize <= 0:
+            terms = ()
+        else:
+            pos, neg = self.masks(np.array([val]), maxBitSetSize, numBits)
+            terms = tuple(MasksToTerms(int(pos[0]), int(neg[0]), numBits))
+        entry = (terms, abs(val - sum(terms)))
+        self._entries[key] = entry
+        if len(self._entries) > self.maxEntries:
+            self._entries.popitem(last=False)
+        return list(entry[0]), entry[1]
+
+    def masks(self, val, maxBitSetSize, numBits=6):
+        '''!
+        @brief Vectorized lookup of the representations of VAL as (posMask, negMask) pairs, signs included
+        '''
+        val = np.asarray(val, dtype=np.float64).reshape(-1)
+        target = np.abs(val)
+        pos = np.empty(val.shape, dtype=np.int64)
+        neg = np.empty(val.shape, dtype=np.int64)
+        search = np.ones(val.shape, dtype=bool)
+        dense = self.denseTable(maxBitSetSize, numBits)
+        if dense is not None:
+            # integer values inside of the dense range are read from the memory map
+            search = (target != np.rint(target)) | (target >= len(dense))
+            rows = dense[target[~search].astype(np.int64)]
+            metrics = GetMetrics()
+            if metrics.enabled:
+                metrics.count('denseReads', len(rows))
+            pos[~search], neg[~search] = rows[:, 0], rows[:, 1]
+        if np.any(search):
+            table = GetSignedPowerTable(int(maxBitSetSize), int(numBits))
+            idx = table.nearest(target[search])
+            pos[search], neg[search] = table.posMask[idx], table.negMask[idx]
+        flip = val < 0
+        pos[flip], neg[flip] = neg[flip], pos[flip]
+        return pos, neg
+
+    def approximate(self, val, maxBitSetSize, numBits=6):
+        '''!
+        @brief Vectorized (hApp, cost) of VAL with at most MAX_BIT_SET_SIZE terms
+        '''
+        val = np.asarray(val, dtype=np.float64).reshape(-1)
+        if maxBitSetSize <= 0:
+            return np.zeros(val.shape, dtype=np.int64), np.abs(val)
+        pos, neg = self.masks(val, maxBitSetSize, numBits)
+        hApp = pos - neg
+        return hApp, np.abs(val - hApp)
+
+    def costTable(self, val, kmax, numBits=6):
+        '''!
+        @brief Best representation of every value of VAL with at most k = 0 .. KMAX terms, in one batched pass
+
+        All the values and all the k are searched in the table of KMAX terms (SignedPowerTable.nearestLevels),
+        or read from the dense tables when there are some; the LRU is bypassed.
+
+        @return (hApp, cost, rep): the approximations and absolute costs, of shape (values, kmax + 1), and the
+                signed exponents of their terms (MasksToExponents), int8 of shape (values, kmax + 1, kmax)
+        '''
+        val = np.asarray(val, dtype=np.float64).reshape(-1)
+        pos = np.zeros((len(val), kmax + 1), dtype=np.int64)
+        neg = np.zeros((len(val), kmax + 1), dtype=np.int64)
+        if kmax > 0 and self.tableDir is not None:
+            for k in range(1, kmax + 1):
+                pos[:, k], neg[:, k] = self.masks(val, k, numBits)
+        elif kmax > 0:
+            table = GetSignedPowerTable(int(kmax), int(numBits))
+            idx = table.nearestLevels(val, kmax)
+            pos[:], neg[:] = table.posMask[idx], table.negMask[idx]
+            flip = val < 0
+            pos[flip], neg[flip] = neg[flip], pos[flip]
+        hApp = pos - neg
+        rep = MasksToExponents(pos, neg, kmax, numBits).reshape(len(val), kmax + 1, kmax)
+        return hApp, np.abs(val[:, None] - hApp), rep
+
+    def denseTable(self, maxBitSetSize, numBits):
+        '''!
+        @brief Memory-mapped table of the representation masks of 0 .. 2^numBits, built on first use
+        '''
+        if self.tableDir is None:
+            return None
+        key = (int(maxBitSetSize), int(numBits))
+        if key not in self._denseTables:
+            path = os.path.join(self.tableDir, f'spt_k{key[0]}_n{key[1]}.npy')
+            if not os.path.exists(path):
+                self.BuildDenseTable(path, *key)
+            self._denseTables[key] = np.load(path, mmap_mode='r')
+        return self._denseTables[key]
+
+    @staticmethod
+    def BuildDenseTable(path, maxBitSetSize, numBits, blockSize=1 << 20):
+        '''!
+        @brief Write the (posMask, negMask) pairs of all integers 0 .. 2^numBits to PATH
+
+        The file is written under a temporary name and renamed, so concurrent builders never expose a partial table.
+        '''
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        table = GetSignedPowerTable(int(maxBitSetSize), int(numBits))
+        size = 2**numBits + 1
+        tmpPath = f'{path}.{os.getpid()}.tmp'
+        dense = np.lib.format.open_memmap(tmpPath, mode='w+', dtype=table.posMask.dtype, shape=(size, 2))
+        for start in range(0, size, blockSize):
+            idx = table.nearest(np.arange(start, min(start + blockSize, size)))
+            dense[start:start + len(idx), 0] = table.posMask[idx]
+            dense[start:start + len(idx), 1] = table.negMask[idx]
+        dense.flush()
+        del dense
+        os.replace(tmpPath, path)
+
+    def stats(self):
+        '''!
+        @brief Hit/miss counters of the cache
+        '''
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': self.hits / total if total else 0.0,
+            'entries': len(self._entries),
+            'denseTables': len(self._denseTables),
+        }
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+## Cache shared by every assignment object and converter of the process
+_sharedCache = None
+
+def GetRepresentationCache():
+    '''!
+    @brief Process wide cache used when no cache is given explicitly
+    '''
+    global _sharedCache
+    if _sharedCache is None:
+        _sharedCache = SparseRepresentationCache()
+    return _sharedCache
@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+#
+# SPDX-License-Identifier: GPL-3.0
+#
+# Project Title: Filter Coefficient Approximation using Sparse Assignment
+#
+
+import numpy as np
+
+
+'''
+Bit-true execution of a sparse integer FIR filter. Every tap is a sum of
+signed powers of two, so the filter output is computed with shifts and
+additions of the integer input only:
+
+    y[n] = ( sum_t sum_e d[t][e] (x[n-t] << e) ) >> denominatorShift
+
+The input is shifted once per distinct exponent and every non-zero digit
+is one vectorized addition (or subtraction) of the shifted input into the
+accumulator at the delay of its tap. The accumulator uses int32 whenever
+the input range allows it, int64 otherwise.
+───────────────────────────────────────────────────────────────────
+             hDigits[NTAPS-1:0][NBITS-1:0]: signed digit d[t][e] of 2^e
+             denominatorShift: final right shift of the accumulator
+───────────────────────────────────────────────────────────────────
+'''
+
+def TermsToSignedDigits(hRep):
+    '''!
+    @brief Signed digit matrix of a list of +/-2^k terms per tap
+    '''
+    width = max([abs(int(term)).bit_length() for rep in hRep for term in rep], default=1)
+    digits = np.zeros((len(hRep), width), dtype=np.int8)
+    for t, rep in enumerate(hRep):
+        for term in rep:
+            digits[t, abs(int(term)).bit_length() - 1] += 1 if term > 0 else -1
+    return digits
+
+
+class ShiftAddFIR(object):
+    '''!
+            Multiplierless FIR filter on integer samples
+    '''
+    def __init__(self, hRep, denominator):
+        '''!
+        @param hRep signed digit matrix (FIRfilterIntegerCoefficients.hDigits) or list of +/-2^k terms per tap
+        @param denominator power of two returned by FIRfilterIntegerCoefficients
+        '''
+        hDigits = np.asarray(hRep) if isinstance(hRep, np.ndarray) else TermsToSignedDigits(hRep)
+        ## Signed digit matrix of the taps
+        self.hDigits = hDigits.astype(np.int8)
+        ## Final right shift
+        self.denominatorShift = int(np.round(np.log2(abs(denominator))))
+        ## Sign of the denominator
+        self.denominatorSign = -1 if denominator < 0 else 1
+        taps, exponents = np.nonzero(self.hDigits)
+        ## Non-zero digits grouped by exponent: exponent -> (tap delays, signs)
+        self.terms = {
+            int(e): (taps[exponents == e], self.hDigits[taps[exponents == e], e])
+            for e in np.unique(exponents)
+        }
+        ## Number of input samples processed at a time
+        self.blockSize = 1 << 16
+
+    @property
+    def numTaps(self):
+        return self.hDigits.shape[0]
+
+    @property
+    def hInteger(self):
+        return self.hDigits.astype(np.int64) @ (np.int64(1) << np.arange(self.hDigits.shape[1], dtype=np.int64))
+
+    @property
+    def numAdditions(self):
+        '''!
+        @brief Number of additions per output sample
+        '''
+        return int(np.count_nonzero(self.hDigits)) - 1
+
+    def accumulatorDtype(self, xMax):
+        '''!
+        @brief Narrowest integer type holding the accumulator for inputs bounded by XMAX in magnitude
+        '''
+        bound = int(xMax) * int(np.sum(np.abs(self.hDigits.astype(np.int64)) @ (np.int64(1) << np.arange(self.hDigits.shape[1], dtype=np.int64))))
+        return np.int32 if bound < 2**31 else np.int64
+
+    def accumulate(self, x, acc, xs=None):
+        '''!
+        @brief Add the shifted and delayed copies of the integer input X into ACC, which holds len(X) + numTaps - 1 samples
+
+        The input is processed in blocks of BLOCK_SIZE samples, so that the shifted
+        block and its accumulator window stay in cache across all the digits.
+        Trailing axes of X are channels filtered in the same pass; a block of all the
+        channels is one contiguous slice, e.g. interleaved I and Q samples.
+
+        @param xs optional buffer of at least min(len(x), BLOCK_SIZE) samples for the shifted input
+        '''
+        if xs is None:
+            xs = np.empty((min(len(x), self.blockSize),) + x.shape[1:], dtype=acc.dtype)
+        for start in range(0, len(x), self.blockSize):
+            xb = x[start:start + self.blockSize]
+            n = len(xb)
+            window = acc[start:start + n + self.numTaps - 1]
+            for e, (taps, signs) in self.terms.items():
+                np.left_shift(xb, e, out=xs[:n])
+                for t, s in zip(taps, signs):
+                    if s > 0:
+                        window[t:t + n] += xs[:n]
+                    else:
+                        window[t:t + n] -= xs[:n]
+        return acc
+
+    def scale(self, acc):
+        '''!
+        @brief Final arithmetic right shift of the accumulator, into int64 in one pass
+        '''
+        y = np.right_shift(acc, self.denominatorShift, dtype=np.int64)
+        return np.negative(y, out=y) if self.denominatorSign < 0 else y
+
+    def __call__(self, x, mode='full'):
+        '''!
+        @brief Filter the integer signal X; complex signals are filtered as interleaved I and Q channels in one pass
+
+        Every exponent and every non-zero digit is one vector pass over the signal, where
+        np.convolve makes one multiply-add per tap in compiled code, so the engine is faster
+        than np.convolve on float data when the taps have few non-zero digits. Measured on 2M
+        samples with 31-75 taps, real signals are 1.5x faster at 1.7 digits per tap and break
+        even near 2.8; complex signals are 1.1x faster at 1.7 digits per tap and break even
+        near 2. Denser taps are better served by np.convolve or by AdderGraphFIR.
+
+        @param x integer (or complex with integer parts) input samples, filtered along the first axis
+        @param mode 'full', 'same' or 'valid', as in np.convolve
+        '''
+        x = np.asarray(x)
+        if np.iscomplexobj(x):
+            # the interleaved float view of the samples is converted in one contiguous pass each way
+            x = np.ascontiguousarray(x, dtype=np.complex128)
+            y = self(x.view(np.float64).reshape(x.shape + (2,)), mode)
+            out = np.empty(y.shape[:-1], dtype=np.complex128)
+            out.view(np.float64).reshape(y.shape)[...] = y
+            return out
+        numSamples = len(x)
+        dtype = self.accumulatorDtype(max(-np.min(x, initial=0), np.max(x, initial=0)))
+        x = x.astype(dtype, copy=False)
+        acc = np.zeros((numSamples + self.numTaps - 1,) + x.shape[1:], dtype=dtype)
+        y = self.scale(self.accumulate(x, acc))
+        if mode == 'full':
+            return y
+        if mode == 'same':
+            start = (min(numSamples, self.numTaps) - 1) // 2
+            return y[start:start + max(numSamples, self.numTaps)]
+        if mode == 'valid':
+            return y[min(numSamples, self.numTaps) - 1:max(numSamples, self.numTaps)]
+        raise ValueError(f'Unknown mode: {mode}')
+
+
+class StreamingShiftAddFIR(object):
+    '''!
+            Block-wise ShiftAddFIR for unbounded streams
+
+    The filter runs in transposed form: the accumulator of a block holds the
+    finished outputs of the block followed by NTAPS-1 partial sums, which are
+    carried over to the next call instead of a delay line of past inputs.
+    All the buffers are allocated once, for blocks of at most BLOCK_SIZE samples.
+    Concatenating the outputs of the calls and of flush() gives the 'full'
+    output of ShiftAddFIR on the whole signal.
+    '''
+    def __init__(self, hRep, denominator=None, blockSize=4096, dtype=np.int64):
+        '''!
+        @param hRep signed digit matrix (FIRfilterIntegerCoefficients.hDigits), list of +/-2^k terms per tap,
+                    or a ShiftAddFIR instance (e.g. an AdderGraphFIR) to run block-wise
+        @param denominator power of two returned by FIRfilterIntegerCoefficients, unused for an instance
+        @param blockSize largest number of samples filtered at a time
+        @param dtype accumulator type, see ShiftAddFIR.accumulatorDtype
+        '''
+        ## Shift-add filter of the taps
+        self.filter = hRep if isinstance(hRep, ShiftAddFIR) else ShiftAddFIR(hRep, denominator)
+        ## Largest number of samples filtered at a time
+        self.blockSize = blockSize
+        self._acc = np.zeros(blockSize + self.filter.numTaps - 1, dtype=dtype)
+        self._x = np.empty(blockSize, dtype=dtype)
+        self._xs = np.empty(blockSize, dtype=dtype)
+
+    def __call__(self, x, out=None):
+        '''!
+        @brief Filter the next chunk X of a real integer stream
+
+        @param x chunk of any length
+        @param out optional int64 array of len(X) receiving the output
+        @return one output sample per input sample
+        '''
+        if out is None:
+            out = np.empty(len(x), dtype=np.int64)
+        delay = self.filter.numTaps - 1
+        for start in range(0, len(x), self.blockSize):
+            n = min(self.blockSize, len(x) - start)
+            self._x[:n] = x[start:start + n]
+            self.filter.accumulate(self._x[:n], self._acc[:n + delay], self._xs)
+            self.scale(self._acc[:n], out[start:start + n])
+            # partial sums of the next samples move to the front of the accumulator
+            self._acc[:delay] = self._acc[n:n + delay]
+            self._acc[delay:n + delay] = 0
+        return out
+
+    def scale(self, acc, out):
+        '''!
+        @brief Final right shift of the finished accumulator samples into OUT, without a temporary
+        '''
+        np.right_shift(acc, self.filter.denominatorShift, out=out)
+        if self.filter.denominatorSign < 0:
+            np.negative(out, out=out)
+        return out
+
+    def flush(self):
+        '''!
+        @brief Remaining NTAPS-1 outputs of the stream; the filter state is cleared
+        '''
+        delay = self.filter.numTaps - 1
+        tail = self.scale(self._acc[:delay], np.empty(delay, dtype=np.int64))
+        self.reset()
+        return tail
+
+    def reset(self):
+        self._acc[:] = 0
+
+
+class DecimatingShiftAddFIR(object):
+    '''!
+            Sparse filter, averaging stage and decimation fused in one polyphase pass
+
+    The reference chain filters at the full rate, convolves with the averager
+    ones(FACTOR)/FACTOR and keeps every FACTOR-th output ([FACTOR-1::FACTOR]).
+    Here the averager is applied first as a running sum of the input (two
+    additions per sample, no division), and the sparse taps are evaluated only at the
+    retained outputs: a digit of tap t adds the polyphase component
+    (n - t) mod FACTOR of the running sum, at the decimated rate.
+    The window of a block is transposed once into its FACTOR polyphase rows, and
+    the running sum is formed per row from their prefix sums over the phases
+    (no full-rate cumulative sum). The digits are added straight into the output
+    in Horner order, from the largest exponent down, with one shift per exponent.
+
+        y[m] = ( sum_t hInteger[t] * B[m*FACTOR + FACTOR-1 - t] ) >> (denominatorShift + log2(FACTOR))
+        B[n] = x[n] + x[n-1] + ... + x[n-FACTOR+1]
+
+    A FACTOR which is not a power of two ends with a floor division instead of the extra shift.
+    '''
+    def __init__(self, hRep, denominator, factor, average=True):
+        '''!
+        @param hRep signed digit matrix (FIRfilterIntegerCoefficients.hDigits) or list of +/-2^k terms per tap
+        @param denominator power of two returned by FIRfilterIntegerCoefficients
+        @param factor decimation factor
+        @param average fuse the ones(FACTOR)/FACTOR averager; False decimates the sparse filter output only
+        '''
+        ## Shift-add filter of the taps
+        self.filter = ShiftAddFIR(hRep, denominator)
+        ## Decimation factor
+        self.factor = factor
+        ## Whether the averaging stage is fused
+        self.average = average
+        delay = self.filter.numTaps - 1
+        ## Polyphase row and component of every digit, largest exponent first: [(exponent, [(row offset, phase, sign)])]
+        self._polyphaseTerms = [
+            (e, [divmod(delay - int(t), factor) + (int(s),) for t, s in zip(taps, signs)])
+            for e, (taps, signs) in sorted(self.filter.terms.items(), reverse=True)
+        ]
+        # work buffers of one block of outputs, allocated once
+        self._rowsPerBlock = max(1, self.filter.blockSize // factor)
+        rows = (self._rowsPerBlock * factor + delay + factor - 1) // factor
+        self._xb = np.empty((rows + 1) * factor, dtype=np.int64)
+        self._phases = np.empty((factor, rows + 1), dtype=np.int64)
+        self._b = np.empty((factor, rows), dtype=np.int64)
+
+    @property
+    def numTaps(self):
+        '''!
+        @brief Length of the composite filter (sparse filter convolved with the averager)
+        '''
+        return self.filter.numTaps + (self.factor - 1 if self.average else 0)
+
+    def outputs(self, x, first, count, out=None):
+        '''!
+        @brief Composite 'full' convolution outputs FIRST, FIRST + FACTOR, ... (COUNT of them), before scaling
+
+        The outputs are computed in blocks of BLOCK_SIZE input samples, so that the polyphase
+        rows of the window, the running sum and the output block stay in cache. The
+        work buffers of a block are allocated once with the filter.
+
+        @param out optional int64 array of COUNT samples receiving the outputs
+        '''
+        D = self.factor
+        delay = self.filter.numTaps - 1
+        acc = np.empty(count, dtype=np.int64) if out is None else out[:count]
+        for m0 in range(0, count, self._rowsPerBlock):
+            c = min(self._rowsPerBlock, count - m0)
+            # running sum samples base .. base + rows*D - 1 cover all the taps of the block,
+            # the window starts one row earlier for the samples of the running sum
+            base = first + m0 * D - delay
+            rows = (c * D + delay + D - 1) // D
+            lo, n = base - D, (rows + 1) * D
+            if 0 <= lo and lo + n <= len(x):
+                xb = x[lo:lo + n]
+            else:
+                xb = self._xb[:n]
+                xb[:] = 0
+                xb[max(0, -lo):max(0, min(len(x), lo + n) - lo)] = x[max(0, lo):max(0, lo + n)]
+            # row p holds the polyphase component p of the window
+            phases = self._phases[:, :rows + 1]
+            phases[:] = xb.reshape(rows + 1, D).T
+            if self.average:
+                # prefix sums over the phases: B[p][r] = sum_{j<=p} X[j][r+1] + sum_{j>p} X[j][r]
+                for p in range(1, D):
+                    phases[p] += phases[p - 1]
+                b = self._b[:, :rows]
+                np.subtract(phases[:D - 1, 1:], phases[:D - 1, :-1], out=b[:D - 1])
+                b[:D - 1] += phases[D - 1, :-1]
+                b[D - 1] = phases[D - 1, 1:]
+            else:
+                b = phases[:, 1:]
+            y = acc[m0:m0 + c]
+            y[:] = 0
+            shift = None
+            for e, terms in self._polyphaseTerms:
+                if shift is not None:
+                    y <<= shift - e
+                for q, p, s in terms:
+                    if s > 0:
+                        y += b[p, q:q + c]
+                    else:
+                        y -= b[p, q:q + c]
+                shift = e
+            if shift:
+                y <<= shift
+        return acc
+
+    def scale(self, acc, out=None):
+        '''!
+        @brief Denominator shift of the sparse filter followed by the division of the averager
+
+        @param out optional int64 array of len(ACC) receiving the output (ACC itself works), without a temporary
+        '''
+        if out is None:
+            y = self.filter.scale(acc)
+        else:
+            y = np.right_shift(acc, self.filter.denominatorShift, out=out)
+            if self.filter.denominatorSign < 0:
+                np.negative(y, out=y)
+        if not self.average:
+            return y
+        if self.factor & (self.factor - 1) == 0:
+            return np.right_shift(y, self.factor.bit_length() - 1, out=y if out is not None else None)
+        return np.floor_divide(y, self.factor, out=y if out is not None else None)
+
+    def __call__(self, x, mode='full'):
+        '''!
+        @brief Decimated output of the integer signal X; complex signals are filtered as separate I and Q channels
+
+        @param x integer (or complex with integer parts) input samples
+        @param mode 'full' keeps the composite outputs [FACTOR-1::FACTOR] of the full convolution,
+                    'valid' keeps the outputs of the same phase which do not depend on samples outside of X
+        '''
+        x = np.asarray(x)
+        if np.iscomplexobj(x):
+            return self(x.real, mode) + 1j * self(x.imag, mode)
+        x = x.astype(np.int64, copy=False)
+        D = self.factor
+        if mode == 'full':
+            first, last = D - 1, len(x) + self.numTaps - 2
+        elif mode == 'valid':
+            first = self.numTaps - 1 + (D - self.numTaps % D) % D
+            last = len(x) - 1
+        else:
+            raise ValueError(f'Unknown mode: {mode}')
+        count = max(0, (last - first) // D + 1)
+        acc = self.outputs(x, first, count)
+        return self.scale(acc, out=acc)
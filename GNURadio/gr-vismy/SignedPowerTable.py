@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+#
+# SPDX-License-Identifier: GPL-3.0
+#
+# Project Title: Filter Coefficient Approximation using Sparse Assignment
+#
+
+import functools
+import itertools as it
+
+import numpy as np
+
+from Instrumentation import GetMetrics
+
+
+'''
+Nearest value search over sums of signed powers of two. Every integer which
+is a sum of at most MAX_BIT_SET_SIZE terms +/-2^i (0 <= i <= numBits) is
+tabulated once in sorted order, so that the best approximation of a value is
+a binary search instead of an enumeration of subsets of the search set.
+
+The table is symmetric around zero and only the non-negative half is stored.
+Each entry keeps its representation as a pair of bit masks: bit i of posMask
+(negMask) is set when +2^i (-2^i) is part of the sum.
+───────────────────────────────────────────────────────────────────
+             values[N-1:0]: sorted non-negative representable values
+             posMask[N-1:0], negMask[N-1:0]: values = posMask - negMask
+             weight[N-1:0]: number of terms of the representation
+───────────────────────────────────────────────────────────────────
+The entries of weight at most k form the table of k terms, so the table of
+KMAX terms answers the searches of every k <= KMAX (nearestLevels) and the
+cost of all the taps for all k is a handful of searchsorted calls.
+'''
+
+class SignedPowerTable(object):
+    '''!
+            Sorted table of all values with at most MAX_BIT_SET_SIZE signed power-of-two terms
+    '''
+    def __init__(self, maxBitSetSize, numBits=6):
+        ## Sparsity requirement of the values
+        self.maxBitSetSize = maxBitSetSize
+        ## Largest shift of the search set
+        self.numBits = numBits
+        self.values, self.posMask, self.negMask, self.weight = self.Build(maxBitSetSize, numBits)
+        self._levels = {}
+
+    @staticmethod
+    def Build(maxBitSetSize, numBits):
+        '''!
+        @brief Enumerate the non-negative sums of at most MAX_BIT_SET_SIZE terms and keep the lightest representation of each value
+
+        A sum is non-negative exactly when its largest term is positive, so only the signs of the lower terms are enumerated.
+        '''
+        dtype = np.int32 if numBits < 31 else np.int64
+        posList = [np.zeros(1, dtype=dtype)]
+        negList = [np.zeros(1, dtype=dtype)]
+        for r in range(1, min(maxBitSetSize, numBits + 1) + 1):
+            combos = np.array(list(it.combinations(range(numBits + 1), r)), dtype=dtype)
+            powers = np.left_shift(dtype(1), combos)
+            signs = ((np.arange(2**(r - 1))[:, None] >> np.arange(r - 1)) & 1).astype(dtype)
+            neg = powers[:, :-1] @ signs.T
+            pos = powers.sum(axis=1, dtype=dtype)[:, None] - neg
+            posList.append(pos.reshape(-1))
+            negList.append(neg.reshape(-1))
+        pos = np.concatenate(posList)
+        neg = np.concatenate(negList)
+        # sums are generated by increasing weight, the first occurrence is the lightest
+        values, first = np.unique(pos - neg, return_index=True)
+        pos, neg = pos[first], neg[first]
+        weight = (SignedPowerTable.PopCount(pos) + SignedPowerTable.PopCount(neg)).astype(np.int8)
+        return values, pos, neg, weight
+
+    @staticmethod
+    def PopCount(mask):
+        '''!
+        @brief Number of set bits of every element of MASK
+        '''
+        mask = mask.astype(np.int64)
+        count = np.zeros(mask.shape, dtype=np.int64)
+        while np.any(mask):
+            count += mask & 1
+            mask = mask >> 1
+        return count
+
+    def nearest(self, val):
+        '''!
+        @brief Index of the closest table entry to |VAL|, ties broken towards the lighter representation
+
+        @param val scalar or array of target values
+        '''
+        target = np.abs(np.asarray(val, dtype=np.float64))
+        metrics = GetMetrics()
+        if metrics.enabled:
+            metrics.count('searchCalls')
+            metrics.count('searchValues', target.size)
+        return self.Search(self.values, self.weight, target)
+
+    @staticmethod
+    def Search(values, weight, target):
+        '''!
+        @brief Index of the closest of the sorted VALUES to every non-negative TARGET, ties broken towards the smaller WEIGHT
+        '''
+        # search with the table dtype, a float key would convert the whole table on every lookup
+        key = np.minimum(np.ceil(target), np.iinfo(values.dtype).max).astype(values.dtype)
+        hi = np.minimum(np.searchsorted(values, key), len(values) - 1)
+        lo = np.maximum(hi - 1, 0)
+        dLo = np.abs(target - values[lo])
+        dHi = np.abs(values[hi] - target)
+        pickLo = (dLo < dHi) | ((dLo == dHi) & (weight[lo] <= weight[hi]))
+        return np.where(pickLo, lo, hi)
+
+    def level(self, k):
+        '''!
+        @brief (indices, values, weights) of the entries with at most K terms, the table of GetSignedPowerTable(K)
+
+        The entries are generated by increasing weight, so the representation kept for a value is the
+        same in both tables.
+        '''
+        k = min(int(k), self.maxBitSetSize)
+        if k not in self._levels:
+            idx = np.flatnonzero(self.weight <= k)
+            self._levels[k] = (idx, self.values[idx], self.weight[idx])
+        return self._levels[k]
+
+    def nearestLevels(self, val, kmax):
+        '''!
+        @brief Index of the closest entry to |VAL| with at most k = 0 .. KMAX terms, for every value at once
+
+        @param val array of target values
+        @param kmax largest number of terms, at most MAX_BIT_SET_SIZE
+        @return indices of shape (values, kmax + 1); column 0 is the zero entry
+        '''
+        if kmax > self.maxBitSetSize:
+            raise ValueError("Number of terms is greater than the Max Bit Set Size of the table")
+        target = np.abs(np.asarray(val, dtype=np.float64)).reshape(-1)
+        metrics = GetMetrics()
+        if metrics.enabled:
+            metrics.count('searchCalls')
+            metrics.count('searchValues', target.size * kmax)
+        idx = np.zeros((len(target), kmax + 1), dtype=np.int64)
+        for k in range(1, kmax + 1):
+            levelIdx, values, weight = self.level(k)
+            idx[:, k] = levelIdx[self.Search(values, weight, target)]
+        return idx
+
+    def approximate(self, val):
+        '''!
+        @brief Closest representable value and the absolute cost, vectorized over VAL
+
+        @return (hApp, cost) with the shape of VAL
+        '''
+        val = np.asarray(val, dtype=np.float64)
+        hApp = np.where(val < 0, -1, 1) * self.values[self.nearest(val)].astype(np.int64)
+        return hApp, np.abs(val - hApp)
+
+    def terms(self, idx, sign=1):
+        '''!
+        @brief Signed power-of-two terms of a table entry, ordered like the search set [2^0 .. 2^numBits, -2^0 .. -2^numBits]
+        '''
+        pos, neg = int(self.posMask[idx]), int(self.negMask[idx])
+        if sign < 0:
+            pos, neg = neg, pos
+        return MasksToTerms(pos, neg, self.numBits)
+
+    def __call__(self, val):
+        '''!
+        @brief Best subset of at most MAX_BIT_SET_SIZE signed powers approximating VAL (same cost as MinSubsetNearTargetSum; between subsets of equal cost the table may keep another one)
+        '''
+        return self.terms(int(self.nearest(val)), -1 if val < 0 else 1)
+
+    def __len__(self):
+        return len(self.values)
+
+
+def MasksToTerms(pos, neg, numBits):
+    '''!
+    @brief Signed power-of-two terms of a (posMask, negMask) pair, ordered like the search set
+    '''
+    return [2**i for i in range(numBits + 1) if pos >> i & 1] + [
+        -(2**i) for i in range(numBits + 1) if neg >> i & 1
+    ]
+
+
+def MasksToSignedDigits(pos, neg, width):
+    '''!
+    @brief Signed digit matrix (one row per value, column i for 2^i) of arrays of (posMask, negMask) pairs
+    '''
+    shifts = np.arange(width, dtype=np.int64)
+    pos = np.asarray(pos, dtype=np.int64).reshape(-1, 1)
+    neg = np.asarray(neg, dtype=np.int64).reshape(-1, 1)
+    return (((pos >> shifts) & 1) - ((neg >> shifts) & 1)).astype(np.int8)
+
+
+def MasksToExponents(pos, neg, width, numBits):
+    '''!
+    @brief Fixed-width int8 rows of the terms of arrays of (posMask, negMask) pairs
+
+    The term +/-2^i is stored as +/-(i + 1) and the unused columns are 0; the terms
+    are ordered like MasksToTerms (positive ones first), so numBits must stay below 127.
+    '''
+    pos = np.asarray(pos, dtype=np.int64).reshape(-1)
+    neg = np.asarray(neg, dtype=np.int64).reshape(-1)
+    rep = np.zeros((len(pos), width), dtype=np.int8)
+    for col in range(width):
+        # the lowest remaining term of the row: positive ones first, by increasing exponent
+        usePos = pos != 0
+        mask = np.where(usePos, pos, neg)
+        low = mask & -mask
+        # frexp(2^i) = (0.5, i + 1)
+        rep[:, col] = np.where(usePos, 1, -1) * np.frexp(low.astype(np.float64))[1]
+        pos = np.where(usePos, pos ^ low, pos)
+        neg = np.where(usePos, neg, neg ^ low)
+    return rep
+
+
+def ExponentsToTerms(rep):
+    '''!
+    @brief Signed power-of-two terms of every row of a MasksToExponents matrix
+    '''
+    return [[int(np.sign(e)) * 2**(abs(int(e)) - 1) for e in row if e] for row in np.asarray(rep).tolist()]
+
+
+@functools.lru_cache(maxsize=None)
+def GetSignedPowerTable(maxBitSetSize, numBits=6):
+    '''!
+    @brief Shared table for a (MAX_BIT_SET_SIZE, numBits) pair; the table is built once per process
+    '''
+    return SignedPowerTable(maxBitSetSize, numBits)
+
+
+def NearestSignedPowerSum(val, maxBitSetSize, numBits=6):
+    '''!
+    @brief Closest approximation of VAL with at most MAX_BIT_SET_SIZE terms +/-2^i, i <= numBits
+
+    Drop-in replacement of MinSubsetNearTargetSum over the signed power-of-two search set
+    '''
+    if maxBitSetSize <= 0:
+        return []
+    return GetSignedPowerTable(int(maxBitSetSize), int(numBits))(val)
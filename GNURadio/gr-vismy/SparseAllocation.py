@@ -0,0 +1,651 @@
+#!/usr/bin/env python
+#
+# SPDX-License-Identifier: GPL-3.0
+#
+# Project Title: Filter Coefficient Approximation using Sparse Assignment
+#
+
+import heapq
+
+import numpy as np
+
+from Instrumentation import GetMetrics
+from SignedPowerTable import ExponentsToTerms
+from TransportOptimization import NonUniformSparseAssignment, OptimalSparseAssignment, SparseAssignmentState
+
+
+'''
+Allocation of a sparse shift budget across the taps of a filter. The
+allocators work on the per-tap assignment objects of TransportOptimization
+and return an AllocationResult with the final per-tap state.
+'''
+
+## Relative score difference below which two cascade moves are a tie (rounding of the response products)
+RELATIVE_TIE = 1e-9
+
+class AllocationResult(object):
+    '''!
+            Per-tap outcome of a sparse budget allocation
+    '''
+    def __init__(self, assgn, hApp, cost, hRep=None, numCalls=0):
+        ## Number of shift assignments of every tap
+        self.assgn = np.asarray(assgn, dtype=np.int64)
+        ## Approximate filter coefficients
+        self.hApp = np.asarray(hApp, dtype=np.int64)
+        ## Absolute cost of every tap
+        self.cost = np.asarray(cost, dtype=np.float64)
+        ## Signed power-of-two terms of every tap
+        self.hRep = hRep
+        ## Number of calls for optimization
+        self.numCalls = numCalls
+        ## Total cost after every budget unit, when the allocator records it
+        self.budgetCost = None
+        ## Frequency response error of the allocation, when the allocator optimizes it
+        self.responseError = None
+        ## Number of exchange moves, when the allocator makes them
+        self.numExchanges = 0
+
+    @classmethod
+    def FromAssignments(cls, taps):
+        '''!
+        @brief Collect the state of a list of UniformSparseAssignment/NonUniformSparseAssignment objects
+        '''
+        return cls(
+            [tap.assgn for tap in taps],
+            [tap._hApp if tap._hApp else 0 for tap in taps],
+            [tap.cost for tap in taps],
+            hRep=[list(tap._hRep) for tap in taps],
+            numCalls=sum(tap.numCalls for tap in taps),
+        )
+
+    @classmethod
+    def FromState(cls, state):
+        '''!
+        @brief Collect a SparseAssignmentState
+        '''
+        return cls(state.assgn, state.hApp, state.cost, hRep=state.hRep, numCalls=state.numCalls)
+
+    @property
+    def totalCost(self):
+        return float(np.sum(self.cost))
+
+    @property
+    def budget(self):
+        return int(np.sum(self.assgn))
+
+    def __str__(self):
+        return f'Total Cost: {self.totalCost} \t Budget Used: {self.budget} \t Num of Calls = {self.numCalls}'
+
+
+def HeapGreedyAllocation(taps, sparseBudget, numBits=6, priority='cost', kmax=None):
+    '''!
+    @brief Spend SPARSE_BUDGET shift assignments one at a time on the tap with the highest priority
+
+    The taps are kept in a max-heap, so every budget unit costs one pop and one push
+    instead of a scan over all the taps; only the tap which received the unit is re-scored.
+    The units are counted on the cost table of the taps, searched once for all of them, and
+    the taps take their representations from the table at the end, as in HybridSparseAllocation.
+
+    @param taps list of UniformSparseAssignment or NonUniformSparseAssignment objects, updated in place
+    @param sparseBudget number of shift assignments to distribute
+    @param numBits largest shift of the search set
+    @param priority 'cost' picks the tap with the largest absolute cost (the NUSA rule),
+                    'gain' picks the tap whose next assignment reduces the cost the most
+    @param kmax largest number of assignments of a tap; None leaves the taps unbounded
+    @return AllocationResult of the taps
+    '''
+    if priority not in ('cost', 'gain'):
+        raise ValueError(f'Unknown priority: {priority}')
+    k = np.array([tap.assgn for tap in taps], dtype=np.int64)
+    cost = np.array([tap.cost for tap in taps], dtype=np.float64)
+    budgetCost = np.full(sparseBudget + 1, float(np.sum(cost)))
+    if not taps:
+        result = AllocationResult.FromAssignments(taps)
+        result.budgetCost = budgetCost
+        return result
+    h = np.array([tap.h for tap in taps], dtype=np.float64)
+    # the table covers every useful number of assignments: beyond it the cost of no tap decreases;
+    # taps above 2^numBits saturate towards the sum of the whole search set, up to numBits + 1 terms
+    width = OptimalSparseAssignment.RequiredBitSetSize(h, numBits)
+    if np.max(np.abs(h)) > 2**numBits:
+        width = max(width, numBits + 1)
+    width = width if kmax is None else min(width, kmax)
+    _, costTable, repTable = taps[0].cache.costTable(h, width, numBits)
+    # a tap asked for k + 1 terms gets fewer when its best representation uses fewer: their count is its next k
+    counts = np.count_nonzero(repTable, axis=2)
+    start = k.copy()
+
+    def key(t):
+        if priority == 'cost':
+            return cost[t]
+        return cost[t] - costTable[t, min(k[t] + 1, width)]
+
+    # ties pop the lowest index first, as np.argmax does
+    heap = [(-key(t), t) for t in range(len(taps))]
+    heapq.heapify(heap)
+    # total cost after every budget unit; the greedy state of budget b is the start of budget b+1
+    totalCost = budgetCost[0]
+    metrics = GetMetrics()
+    for b in range(1, sparseBudget + 1):
+        if not heap:
+            budgetCost[b:] = totalCost
+            break
+        _, idx = heapq.heappop(heap)
+        totalCost -= cost[idx]
+        k[idx] = counts[idx, min(k[idx] + 1, width)]
+        cost[idx] = costTable[idx, k[idx]]
+        totalCost += cost[idx]
+        budgetCost[b] = totalCost
+        if metrics.enabled:
+            metrics.count('allocationUnits')
+        if kmax is None or k[idx] < kmax:
+            heapq.heappush(heap, (-key(idx), idx))
+    # the representations are read from the table once, for the taps which received units
+    for t in np.flatnonzero(k != start):
+        taps[t].assignTerms(ExponentsToTerms(repTable[t, k[t]:k[t] + 1])[0])
+    result = AllocationResult.FromAssignments(taps)
+    result.budgetCost = budgetCost
+    return result
+
+
+def UniformSparseAllocation(hCoeffs, sparseBudget, numBits=6, boundary=None, kmax=None, cache=None):
+    '''!
+    @brief UNSA: the BOUNDARY largest taps share SPARSE_BUDGET evenly, the remainder goes to the costliest of them
+
+    The split is made on the cost table of the taps and the representations are read from it once.
+
+    @param hCoeffs integer filter coefficients
+    @param sparseBudget number of shift assignments to distribute
+    @param numBits largest shift of the search set
+    @param boundary number of largest taps sharing the budget; None uses all the taps
+    @param kmax largest number of assignments of a tap; None uses the largest useful one
+    @return AllocationResult of the taps
+    '''
+    state = SparseAssignmentState(hCoeffs, numBits=numBits, cache=cache, kmax=kmax)
+    table = state.costTable()
+    k = np.zeros(len(state), dtype=np.int64)
+    # a boundary beyond the number of taps covers all of them
+    b = len(state) if boundary is None else min(int(boundary), len(state))
+    q, r = divmod(sparseBudget, b) if b else (0, 0)
+    largest = np.argsort(np.abs(state.h), kind='stable')[len(state) - b:]
+    # the table stops at kmax, where ASSIGN clips the requests
+    k[largest] = min(q, state.kmax)
+    if r:
+        k[largest[np.argsort(table[1][largest, k[largest]], kind='stable')[-r:]]] = min(q + 1, state.kmax)
+    state.assignFromTable(table, np.flatnonzero(k), k[k > 0])
+    return AllocationResult.FromState(state)
+
+
+def HybridSparseAllocation(hCoeffs, sparseBudget, numBits=6, boundary=None, maxMoves=None, kmax=None, cache=None):
+    '''!
+    @brief HYSA: uniform split over the largest taps, greedy NUSA fill, then exchange of single assignments
+
+    1. the BOUNDARY largest taps get sparseBudget // boundary assignments each; the
+       remainder and the assignments they cannot use go to the greedy phase
+    2. the remaining units are spent one at a time on the tap of largest cost (NUSA rule),
+       popped from a heap of the taps keyed on their cost
+    3. exchange: one assignment moves from a donor tap to a receiver tap when it lowers the
+       total cost. The cost is separable over the taps, so the best of all (donor, receiver)
+       pairs is the tap whose cost grows least when it gives a unit against the tap whose cost
+       drops most when it takes one. Both are read from the per-tap cost-versus-k table,
+       making a move O(taps) vectorized work. The best improving move is applied until
+       none is left (a local optimum) or MAX_MOVES moves were made.
+    All three phases run on the number of assignments of the cost table, and the representations
+    are read from the same table at the end.
+
+    @param hCoeffs integer filter coefficients
+    @param sparseBudget number of shift assignments to distribute
+    @param numBits largest shift of the search set
+    @param boundary number of largest taps of the uniform split; None uses all the taps
+    @param maxMoves bound on the number of exchanges; None runs to the local optimum
+    @param kmax largest number of assignments of a tap; None uses the largest useful one
+    @return AllocationResult of the taps, numExchanges set
+    '''
+    state = SparseAssignmentState(hCoeffs, numBits=numBits, cache=cache, kmax=kmax)
+    table = state.costTable()
+    costTable = table[1]
+    taps = np.arange(len(state))
+    k = np.zeros(len(state), dtype=np.int64)
+
+    # a boundary beyond the number of taps covers all of them
+    b = len(state) if boundary is None else min(int(boundary), len(state))
+    q, r = divmod(sparseBudget, b) if b else (0, sparseBudget)
+    if q:
+        largest = np.argsort(np.abs(state.h), kind='stable')[len(state) - b:]
+        q = min(q, state.kmax)
+        # a tap takes fewer assignments when its cost stops decreasing before q
+        k[largest] = np.argmax(costTable[largest, :q + 1] == costTable[largest, q:q + 1], axis=1)
+        r = sparseBudget - int(np.sum(k))
+    # max-heap of the taps which can still take a unit, keyed on their current cost
+    heap = [(-costTable[t, k[t]], t) for t in taps.tolist() if k[t] < state.kmax]
+    heapq.heapify(heap)
+    for _ in range(r):
+        if not heap or heap[0][0] == 0:
+            break
+        _, t = heapq.heappop(heap)
+        k[t] += 1
+        if k[t] < state.kmax:
+            heapq.heappush(heap, (-costTable[t, k[t]], t))
+
+    numExchanges = 0
+    metrics = GetMetrics()
+    while maxMoves is None or numExchanges < maxMoves:
+        gain, loss = state.exchangeCandidates(costTable, k)
+        if metrics.enabled:
+            # every (donor, receiver) pair is scored by the two vectors
+            metrics.count('exchangeRounds')
+            metrics.count('candidatesEvaluated', 2 * len(state))
+        receiver, donor = int(np.argmax(gain)), int(np.argmin(loss))
+        if receiver == donor:
+            # the best receiver and donor are the same tap: pair it with the runner-up of the other side
+            gain2, loss2 = gain.copy(), loss.copy()
+            gain2[receiver], loss2[donor] = -np.inf, np.inf
+            r2, d2 = int(np.argmax(gain2)), int(np.argmin(loss2))
+            receiver, donor = (receiver, d2) if gain[receiver] - loss2[d2] >= gain2[r2] - loss[donor] else (r2, donor)
+        if not gain[receiver] - loss[donor] > 0:
+            break
+        k[donor] -= 1
+        k[receiver] += 1
+        numExchanges += 1
+        if metrics.enabled:
+            metrics.count('exchangeMoves')
+
+    state.assignFromTable(table, taps, k)
+    result = AllocationResult.FromState(state)
+    result.numExchanges = numExchanges
+    return result
+
+
+def SparseBudgetSweep(hCoeffs, maxBudget, numBits=6, method='optimal'):
+    '''!
+    @brief Total cost of the filter for every sparse budget 0 .. MAX_BUDGET in a single run
+
+    'optimal' reads the curve off the dynamic program of OptimalSparseAssignment, which
+    solves every budget at once. 'nusa' runs the greedy allocation once and records the
+    cost after every unit, since the NUSA state of budget b+1 extends the state of budget b.
+
+    @param hCoeffs integer filter coefficients
+    @param maxBudget largest sparse budget of the sweep
+    @param numBits largest shift of the search set
+    @param method 'optimal' or 'nusa'
+    @return array of length MAX_BUDGET + 1 with the total cost of budget b at index b
+    '''
+    if method == 'optimal':
+        osa = OptimalSparseAssignment(hCoeffs)
+        osa(maxBudget, numBits=numBits)
+        return osa.budgetCost.copy()
+    if method == 'nusa':
+        nusa = [NonUniformSparseAssignment(i, el) for i, el in enumerate(hCoeffs)]
+        return HeapGreedyAllocation(nusa, maxBudget, numBits=numBits).budgetCost
+    raise ValueError(f'Unknown method: {method}')
+
+
+def MinimumSparseBudget(budgetCost, targetCost):
+    '''!
+    @brief Smallest budget of a SparseBudgetSweep curve whose total cost meets TARGET_COST, None when no budget does
+    '''
+    budgets = np.flatnonzero(np.asarray(budgetCost) <= targetCost)
+    return int(budgets[0]) if budgets.size else None
+
+
+def ResponseMatrix(numTaps, gridSize=512, rate=1):
+    '''!
+    @brief DFT matrix of a real filter on GRID_SIZE frequencies of [0, pi]
+
+    @param rate decimation factor in front of the filter; the response is taken at RATE * w,
+                w being the frequency at the input of the chain
+    @return (E, w) with H(w) = E @ h
+    '''
+    w = np.linspace(0, np.pi, gridSize)
+    return np.exp(-1j * np.outer(rate * w, np.arange(numTaps))), w
+
+
+def CascadeResponse(hStages, rates=None, gridSize=512):
+    '''!
+    @brief Composite response of a cascade of filters, the product of the stage responses
+
+    @param hStages taps of every stage, in the order of the cascade
+    @param rates decimation factor in front of every stage (the product of the factors of the
+                 previous stages); None for a single rate cascade
+    @return (H, w) on GRID_SIZE frequencies of [0, pi] at the input of the cascade
+    '''
+    rates = [1] * len(hStages) if rates is None else rates
+    H = np.ones(gridSize, dtype=np.complex128)
+    for h, rate in zip(hStages, rates):
+        E, w = ResponseMatrix(len(h), gridSize, rate)
+        H *= E @ np.asarray(h, dtype=np.float64)
+    return H, w
+
+
+def ResponseError(R, order=2):
+    '''!
+    @brief (max |R|, sum |R|^ORDER) of the response difference R, one column per candidate
+    '''
+    mag = np.abs(R)
+    return np.max(mag, axis=0), np.sum(mag**order, axis=0)
+
+
+def ResponseScores(r, E, d, candidates, order, E2=None):
+    '''!
+    @brief sum |r + d[i] E[:, candidates[i]]|^ORDER of every candidate move, without forming the moved responses
+
+    The columns of E are unit exponentials, so with A = |r|^2 and P_t = Re(conj(r) E[:, t])
+    |r + d E_t|^2 = A + d^2 + 2 d P_t. Summed over the grid, its square (ORDER 4) only needs
+    sum A P_t, sum P_t and sum P_t^2 = (sum A + Re sum conj(r)^2 E_t^2) / 2: three products of
+    the grid vectors with E and E2 = E * E instead of a grid by candidates matrix per move.
+    Other orders score the moved responses directly.
+
+    @param r residual response
+    @param E response matrix of the taps (ResponseMatrix)
+    @param d change of every candidate tap
+    @param candidates taps of the moves
+    @param order exponent of the score
+    @param E2 E * E, for ORDER 4
+    '''
+    if order not in (2, 4):
+        return ResponseError(r[:, None] + E[:, candidates] * d, order)[1]
+    gridSize = len(r)
+    A = np.abs(r)**2
+    sumA = np.sum(A)
+    if order == 2:
+        z = np.real(np.conj(r) @ E[:, candidates])
+        return sumA + gridSize * d**2 + 2 * d * z
+    u, z = np.real(np.vstack([A * np.conj(r), np.conj(r)]) @ E)[:, candidates]
+    y = np.real(np.conj(r)**2 @ E2)[candidates]
+    return np.sum(A**2) + 2 * d**2 * sumA + gridSize * d**4 + 4 * d * (u + d**2 * z) + 2 * d**2 * (sumA + y)
+
+
+def ResponseGreedy(hTarget, hTable, E, sparseBudget, order=4):
+    '''!
+    @brief Greedy moves of FrequencyResponseAllocation: the tap receiving every budget unit
+
+    @param hTarget taps in the integer domain
+    @param hTable approximation of every tap for k = 0 .. kmax assignments (OptimalSparseAssignment.costTable)
+    @param E response matrix of the taps (ResponseMatrix)
+    @param sparseBudget largest number of units
+    @param order exponent of the score sum |R|^ORDER
+    @return (moves, peaks, scores): the tap of every unit, and max |R| and sum |R|^ORDER
+            after 0 .. len(moves) units; the moves stop early when no candidate lowers the score
+    '''
+    numTaps = len(hTarget)
+    kmax = hTable.shape[1] - 1
+    k = np.zeros(numTaps, dtype=np.int64)
+    hApp = hTable[:, 0].copy()
+    R = E @ (hApp - hTarget)
+    peak, score = (float(v[0]) for v in ResponseError(R[:, None], order))
+    moves, peaks, scores = [], [peak], [score]
+    taps = np.arange(numTaps)
+    E2 = E * E if order == 4 else None
+    metrics = GetMetrics()
+    for _ in range(sparseBudget):
+        open_ = k < kmax
+        delta = np.where(open_, hTable[taps, np.minimum(k + 1, kmax)] - hApp, 0)
+        candidates = np.flatnonzero(open_ & (delta != 0))
+        if candidates.size == 0:
+            break
+        # scores are taken relative to the current peak so that high orders do not overflow
+        candScores = ResponseScores(R / peak, E, delta[candidates] / peak, candidates, order, E2)
+        if metrics.enabled:
+            metrics.count('candidatesEvaluated', candidates.size)
+        best = int(np.argmin(candScores))
+        if candScores[best] >= score / peak**order:
+            break
+        t = candidates[best]
+        R += delta[t] * E[:, t]
+        hApp[t] += delta[t]
+        k[t] += 1
+        peak, score = float(np.max(np.abs(R))), candScores[best] * peak**order
+        moves.append(int(t))
+        peaks.append(peak)
+        scores.append(score)
+    return moves, peaks, scores
+
+
+def FrequencyResponseAllocation(hTarget, sparseBudget, numBits=6, gridSize=512, norm='minimax', kmax=None, order=4):
+    '''!
+    @brief Greedy allocation of SPARSE_BUDGET assignments minimizing the frequency response error
+
+    The objective is the error between the response of the sparse taps and the response of
+    the floating point taps on a dense grid: minimax (max |H - Happ|, the stopband/ripple view)
+    or 'l2' (the response energy).
+    Each budget unit goes to the tap whose next approximation lowers the error most.
+    All candidates are scored at once from the residual response R = E (hApp - hTarget):
+    giving one more assignment to tap t changes R by the rank-1 term delta[t] * E[:, t], so no
+    FFT is computed; the scores of all the moves follow from a few products of R with E
+    (ResponseScores) and after the move only R and the candidate of that tap are updated.
+    Greedy moves on the peak itself stall as soon as no single tap lowers the maximum, so the
+    minimax moves are scored on sum |R|^ORDER, which follows the peak while still rewarding
+    the moves that lower the error elsewhere, and the allocation with the lowest peak is returned.
+    The allocation stops early when no candidate lowers the score.
+
+    @param hTarget floating point taps scaled to the integer domain, e.g. hFIR / 2**-reqBits
+    @param sparseBudget number of shift assignments to distribute
+    @param numBits largest shift of the search set
+    @param gridSize number of frequencies of [0, pi]
+    @param norm 'minimax' or 'l2'
+    @param kmax largest number of assignments of a tap
+    @param order exponent of the minimax score
+    @return AllocationResult with responseError set (peak for minimax, energy for l2)
+    '''
+    if norm not in ('minimax', 'l2'):
+        raise ValueError(f'Unknown norm: {norm}')
+    order = order if norm == 'minimax' else 2
+    osa = OptimalSparseAssignment(hTarget)
+    numTaps = len(osa.h)
+    kmax = min(sparseBudget, OptimalSparseAssignment.RequiredBitSetSize(osa.h, numBits)) if kmax is None else kmax
+    hTable, _, repTable = osa.costTable(kmax, numBits)
+    E, _ = ResponseMatrix(numTaps, gridSize)
+    moves, peaks, scores = ResponseGreedy(osa.h, hTable, E, sparseBudget, order)
+
+    # the minimax allocation is the prefix of the moves with the lowest peak
+    numMoves = int(np.argmin(peaks)) if norm == 'minimax' else len(moves)
+    k = np.bincount(np.array(moves[:numMoves], dtype=np.int64), minlength=numTaps)
+    taps = np.arange(numTaps)
+    hApp = hTable[taps, k]
+    hRep = ExponentsToTerms(repTable[taps, k])
+    result = AllocationResult([len(rep) for rep in hRep], hApp, np.abs(osa.h - hApp), hRep=hRep)
+    result.responseError = float(peaks[numMoves] if norm == 'minimax' else scores[-1])
+    return result
+
+
+class CascadeAllocationResult(object):
+    '''!
+            Outcome of a joint sparse budget allocation over the stages of a cascade
+    '''
+    def __init__(self, stages, responseError, budgetCost):
+        ## AllocationResult of every stage, in the order of the cascade
+        self.stages = stages
+        ## Composite frequency response error of the allocation (peak for minimax, energy for l2)
+        self.responseError = responseError
+        ## Composite response error reached with at most b budget units, at index b
+        self.budgetCost = budgetCost
+
+    @property
+    def stageBudgets(self):
+        return [stage.budget for stage in self.stages]
+
+    @property
+    def budget(self):
+        return int(sum(self.stageBudgets))
+
+    def __str__(self):
+        return f'Response Error: {self.responseError} \t Budget Used: {self.budget} \t Stage Budgets = {self.stageBudgets}'
+
+
+def CascadeSparseAllocation(hStages, sparseBudget, numBits=6, rates=None, gridSize=512, norm='minimax', kmax=None, order=4, maxStep=None):
+    '''!
+    @brief Split one SPARSE_BUDGET across the stages of a cascade, minimizing the error of the composite response
+
+    The composite response is the product of the stage responses H(w) = prod_s H_s(rate_s w).
+    Greedy moves of single taps stall on a product (no stage contributes while another one is
+    still zero, and a stage whose gain is off cannot be corrected one term at a time), so the
+    search runs on the budget of every stage instead:
+    1. every stage runs its own FrequencyResponseAllocation greedy (ResponseGreedy) on its cost
+       table, which orders its taps for every stage budget b_s; its response at b_s units, at
+       the rate of the stage, follows from rank-1 updates. This costs one single-filter run per
+       stage.
+    2. the budget goes to the stage whose next 1 .. MAX_STEP units lower the composite score
+       most per unit, while any does; the lookahead steps over units which only pay off together
+       (the error of a stage is masked until the others catch up)
+    3. exchange: up to MAX_STEP units move from one stage to another while the composite
+       score decreases
+    A state is scored on sum |R|^ORDER of the composite residual R for minimax (the allocation
+    with the lowest peak is returned) and on the energy for 'l2', as in FrequencyResponseAllocation.
+    A candidate multiplies the changed stages into the product of the unchanged ones, computed
+    once per move, so a unit of step 2 costs O(S MAX_STEP) grid products and a round of step 3
+    O(S^2 MAX_STEP) for S stages: the joint search grows quadratically with the number of stages.
+    Moves whose gains tie go to the stage left with the fewest units, so identical stages take
+    their units in turn; the result may still split them unevenly, since the error of a stage
+    does not fall convexly with its budget and an uneven split measures lower (two copies of a
+    15 tap stage reach 0.0013 with [32, 23] units and 0.0024 at best with equal budgets).
+
+    @param hStages floating point taps of every stage, in the order of the cascade
+    @param sparseBudget number of shift assignments to distribute over all the stages
+    @param numBits largest shift of the search set; a scalar or one value per stage. The taps
+                   of stage s are quantized as hStages[s] / 2**-numBits[s]
+    @param rates decimation factor in front of every stage; None for a single rate cascade
+    @param gridSize number of frequencies of [0, pi]
+    @param norm 'minimax' or 'l2'
+    @param kmax largest number of assignments of a tap
+    @param order exponent of the minimax score
+    @param maxStep largest number of units added to or moved between stages at once; None looks
+                   ahead over the whole remaining budget of a stage
+    @return CascadeAllocationResult; its budgetCost curve gives, through MinimumSparseBudget,
+            the smallest total budget meeting a composite specification
+    '''
+    if norm not in ('minimax', 'l2'):
+        raise ValueError(f'Unknown norm: {norm}')
+    order = order if norm == 'minimax' else 2
+    numStages = len(hStages)
+    numBits = [int(nb) for nb in np.broadcast_to(numBits, (numStages,))]
+    rates = [1] * numStages if rates is None else rates
+    target, _ = CascadeResponse(hStages, rates, gridSize)
+
+    # per stage: greedy order of the units and its response at the input of the cascade for every budget
+    hTargets, hTables, repTables, stageMoves, responses = [], [], [], [], []
+    for h, nb, rate in zip(hStages, numBits, rates):
+        osa = OptimalSparseAssignment(np.asarray(h, dtype=np.float64) / 2.0**-nb)
+        ks = min(sparseBudget, OptimalSparseAssignment.RequiredBitSetSize(osa.h, nb)) if kmax is None else kmax
+        hTable, _, repTable = osa.costTable(ks, nb)
+        E, _ = ResponseMatrix(len(osa.h), gridSize)
+        moves, _, _ = ResponseGreedy(osa.h, hTable, E, sparseBudget, order)
+        # change of the taps made by every move
+        k = np.zeros(len(osa.h), dtype=np.int64)
+        delta = np.zeros(len(moves))
+        for i, t in enumerate(moves):
+            delta[i] = hTable[t, k[t] + 1] - hTable[t, k[t]]
+            k[t] += 1
+        Erate, _ = ResponseMatrix(len(osa.h), gridSize, rate)
+        H = np.empty((len(moves) + 1, gridSize), dtype=np.complex128)
+        H[0] = Erate @ hTable[:, 0] * 2.0**-nb
+        H[1:] = H[0] + np.cumsum((Erate[:, moves] * delta).T, axis=0) * 2.0**-nb
+        hTargets.append(osa.h)
+        hTables.append(hTable)
+        repTables.append(repTable)
+        stageMoves.append(moves)
+        responses.append(H)
+    limits = np.array([len(moves) for moves in stageMoves])
+    maxStep = sparseBudget if maxStep is None else maxStep
+
+    def others(factors):
+        # product of all the rows but one, for every row, from prefix and suffix products (no division by zeros)
+        prefix = np.cumprod(np.vstack([np.ones(gridSize), factors[:-1]]), axis=0)
+        suffix = np.cumprod(np.vstack([np.ones(gridSize), factors[:0:-1]]), axis=0)[::-1]
+        return prefix * suffix
+
+    # the error of the best state visited with every total budget
+    visited = np.full(sparseBudget + 1, np.inf)
+    budgets = np.zeros(numStages, dtype=np.int64)
+    R = np.prod([H[0] for H in responses], axis=0) - target
+    peak, score = (float(v[0]) for v in ResponseError(R[:, None], order))
+    bestPeak, bestBudgets = peak, budgets.copy()
+    visited[0] = peak if norm == 'minimax' else score
+    metrics = GetMetrics()
+
+    def visit(composite, candidates):
+        # scores the composite responses of the candidate budgets, one row each
+        nonlocal bestPeak, bestBudgets
+        p, sc = ResponseError((composite - target).T, order)
+        np.minimum.at(visited, np.sum(candidates, axis=1), p if norm == 'minimax' else sc)
+        i = int(np.argmin(p))
+        if p[i] < bestPeak:
+            bestPeak, bestBudgets = float(p[i]), candidates[i].copy()
+        if metrics.enabled:
+            metrics.count('candidatesEvaluated', len(candidates))
+        return p, sc
+
+    def level(options):
+        # among the moves tied on the gain, the one leaving the lowest largest stage budget, then the first one,
+        # so that identical stages take their units in turn
+        top = max(o[0] for o in options)
+        tied = [o for o in options if o[0] >= top - RELATIVE_TIE * abs(top)]
+        return min(tied, key=lambda o: (max(o[1]), list(o[1])))
+
+    # the composite response stays zero while one stage is: every stage starts with its first unit
+    if np.sum(np.minimum(limits, 1)) <= sparseBudget:
+        budgets = np.minimum(limits, 1)
+        composite = np.prod([H[b] for H, b in zip(responses, budgets)], axis=0)
+        p, sc = visit(composite[None, :], budgets[None, :])
+        peak, score = float(p[0]), float(sc[0])
+
+    # every candidate is the product of the unchanged stages (computed once per move) and the changed ones,
+    # so a move costs O(numStages * maxStep) vector products and an exchange round O(numStages**2 * maxStep)
+    while np.sum(budgets) < sparseBudget:
+        left = sparseBudget - int(np.sum(budgets))
+        rest = others(np.array([H[b] for H, b in zip(responses, budgets)]))
+        options = []
+        for s in range(numStages):
+            steps = np.arange(1, min(maxStep, limits[s] - budgets[s], left) + 1)
+            if steps.size == 0:
+                continue
+            candidates = np.repeat(budgets[None, :], steps.size, axis=0)
+            candidates[:, s] += steps
+            p, sc = visit(rest[s] * responses[s][budgets[s] + steps], candidates)
+            gain = (score - sc) / steps
+            options += [(gain[i], candidates[i], p[i], sc[i]) for i in range(steps.size)]
+        if not options:
+            break
+        gain, candidate, p, sc = level(options)
+        if not gain > 0:
+            break
+        budgets, peak, score = candidate, float(p), float(sc)
+        if metrics.enabled:
+            metrics.count('allocationUnits')
+
+    while True:
+        current = np.array([H[b] for H, b in zip(responses, budgets)])
+        options = []
+        for donor in range(numStages):
+            # products without the donor and one receiver
+            rest = others(np.where(np.arange(numStages)[:, None] == donor, 1, current))
+            for receiver in range(numStages):
+                steps = np.arange(1, min(maxStep, budgets[donor], limits[receiver] - budgets[receiver]) + 1)
+                if donor == receiver or steps.size == 0:
+                    continue
+                candidates = np.repeat(budgets[None, :], steps.size, axis=0)
+                candidates[:, donor] -= steps
+                candidates[:, receiver] += steps
+                composite = rest[receiver] * responses[donor][budgets[donor] - steps] * responses[receiver][budgets[receiver] + steps]
+                p, sc = visit(composite, candidates)
+                options += [(score - sc[i], candidates[i], p[i], sc[i]) for i in range(steps.size)]
+        # a move must lower the score beyond the rounding of the products, or identical stages trade units forever
+        options = [o for o in options if o[0] > RELATIVE_TIE * score]
+        if not options:
+            break
+        _, budgets, peak, score = level(options)
+        peak, score = float(peak), float(score)
+        if metrics.enabled:
+            metrics.count('exchangeMoves')
+
+    if norm == 'minimax':
+        budgets = bestBudgets
+    stages = []
+    for s in range(numStages):
+        taps = np.arange(len(hTargets[s]))
+        k = np.bincount(np.array(stageMoves[s][:budgets[s]], dtype=np.int64), minlength=len(taps))
+        hRep = ExponentsToTerms(repTables[s][taps, k])
+        hApp = hTables[s][taps, k]
+        stages.append(AllocationResult([len(rep) for rep in hRep], hApp, np.abs(hTargets[s] - hApp), hRep=hRep))
+    return CascadeAllocationResult(
+        stages, float(bestPeak if norm == 'minimax' else score), np.minimum.accumulate(visited)
+    )
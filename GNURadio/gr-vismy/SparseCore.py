@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+#
+# SPDX-License-Identifier: GPL-3.0
+#
+# Project Title: Filter Coefficient Approximation using Sparse Assignment
+#
+
+from DesignCache import DesignCache, DesignKey
+from FirTapsToInteger import FIRfilterIntegerCoefficients
+from Instrumentation import GetMetrics, Metrics, RunReport
+from RepresentationCache import GetRepresentationCache, SparseRepresentationCache
+from SignedPowerTable import GetSignedPowerTable, NearestSignedPowerSum, SignedPowerTable
+from SparseAllocation import (
+    AllocationResult,
+    CascadeAllocationResult,
+    CascadeResponse,
+    CascadeSparseAllocation,
+    FrequencyResponseAllocation,
+    HeapGreedyAllocation,
+    HybridSparseAllocation,
+    MinimumSparseBudget,
+    ResponseMatrix,
+    SparseBudgetSweep,
+    UniformSparseAllocation,
+)
+from TransportOptimization import (
+    NonUniformSparseAssignment,
+    OptimalSparseAssignment,
+    SparseAssignmentState,
+    UniformSparseAssignment,
+)
+
+
+'''
+Quantization and allocation core. It depends on NumPy and the standard
+library only, so that short-lived jobs which quantize a filter do not pay for
+importing gnuradio, matplotlib or loguru; those are imported by the demo and
+plotting paths (FirTapsToInteger.main, TestTransAlgorithms, BenchmarkSparse)
+when they run. The core logs through the standard logging module.
+
+Importing this module must stay within IMPORT_TIME_BUDGET seconds in a fresh
+interpreter, NumPy included; main_import in TestTransAlgorithms checks it.
+'''
+
+## Wall time budget in seconds of "import SparseCore" in a fresh interpreter
+IMPORT_TIME_BUDGET = 0.5
+
+## Modules which the core must not import
+HEAVY_MODULES = ('gnuradio', 'matplotlib', 'loguru', 'scipy')
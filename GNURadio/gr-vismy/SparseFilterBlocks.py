@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+#
+# SPDX-License-Identifier: GPL-3.0
+#
+# Project Title: Filter Coefficient Approximation using Sparse Assignment
+#
+
+import time
+
+import numpy as np
+from gnuradio import gr
+
+from ShiftAddFilter import DecimatingShiftAddFIR, ShiftAddFIR, StreamingShiftAddFIR
+
+
+'''
+GNU Radio blocks running the sparse filter of FIRfilterIntegerCoefficients on
+complex streams with the shift-add engines of ShiftAddFilter. The samples are
+converted to integers of INPUT_BITS fractional bits (full scale +/-1.0,
+clipped), I and Q are filtered as separate integer channels and the output
+is scaled back to float, so the blocks drop in where fir_filter_ccf with the
+taps hTruncated / denominator is used.
+───────────────────────────────────────────────────────────────────
+             SparseFIRFilterCCF: sync block, transposed-form StreamingShiftAddFIR
+                                 per channel, state carried between work() calls
+             SparseFIRDecimatorCCF: decimating block, set_history(NTAPS) and the
+                                 polyphase DecimatingShiftAddFIR on the window
+───────────────────────────────────────────────────────────────────
+All the conversion and filter buffers are allocated once (for the largest
+work() call seen so far), so the steady state of a flowgraph does not
+allocate per call.
+'''
+
+class _IntegerIO(object):
+    '''!
+            Reusable float <-> integer conversion buffers of the complex blocks
+    '''
+    def __init__(self, inputBits, dtype):
+        ## Fractional bits of the integer samples
+        self.inputBits = inputBits
+        ## Integer sample type of the engines
+        self.dtype = dtype
+        self._scale = float(2**inputBits)
+        self._size = 0
+        self._grow(4096)
+
+    def _grow(self, n):
+        if n <= self._size:
+            return
+        self._size = max(n, 2 * self._size)
+        self._f = np.empty(self._size, dtype=np.float32)
+        self._i = np.empty(self._size, dtype=self.dtype)
+        self._q = np.empty(self._size, dtype=self.dtype)
+        self._y = np.empty(self._size, dtype=np.int64)
+
+    def toInteger(self, x):
+        '''!
+        @brief I and Q of the complex samples X as integers, views of the internal buffers
+        '''
+        n = len(x)
+        self._grow(n)
+        for part, buf in ((x.real, self._i), (x.imag, self._q)):
+            np.multiply(part, self._scale, out=self._f[:n])
+            np.rint(self._f[:n], out=self._f[:n])
+            np.clip(self._f[:n], -self._scale, self._scale, out=self._f[:n])
+            buf[:n] = self._f[:n]
+        return self._i[:n], self._q[:n]
+
+    def output(self, n):
+        '''!
+        @brief Integer output buffer of N samples
+        '''
+        self._grow(n)
+        return self._y[:n]
+
+    def toFloat(self, y, out):
+        '''!
+        @brief Scale the integer samples Y back to float into OUT (a real or imaginary view)
+        '''
+        np.multiply(y, 1.0 / self._scale, out=out, casting='unsafe')
+
+
+class SparseFIRFilterCCF(gr.sync_block):
+    '''!
+            Complex FIR filter with the sparse integer taps, one output per input sample
+    '''
+    def __init__(self, hRep, denominator, inputBits=15, blockSize=4096):
+        '''!
+        @param hRep signed digit matrix (FIRfilterIntegerCoefficients.hDigits) or list of +/-2^k terms per tap
+        @param denominator power of two returned by FIRfilterIntegerCoefficients
+        @param inputBits fractional bits of the integer samples
+        @param blockSize largest number of samples filtered at a time by the engines
+        '''
+        gr.sync_block.__init__(self, name='SparseFIRFilterCCF', in_sig=[np.complex64], out_sig=[np.complex64])
+        fir = ShiftAddFIR(hRep, denominator)
+        dtype = fir.accumulatorDtype(2**inputBits)
+        ## Engines of the I and Q channels
+        self.channels = [StreamingShiftAddFIR(fir, blockSize=blockSize, dtype=dtype) for _ in range(2)]
+        self._io = _IntegerIO(inputBits, dtype)
+
+    def work(self, input_items, output_items):
+        x, y = input_items[0], output_items[0]
+        n = len(y)
+        for channel, xi, part in zip(self.channels, self._io.toInteger(x[:n]), (y.real, y.imag)):
+            out = self._io.output(n)
+            channel(xi, out=out)
+            self._io.toFloat(out, part)
+        return n
+
+
+class SparseFIRDecimatorCCF(gr.decim_block):
+    '''!
+            Complex decimating FIR filter with the sparse integer taps, evaluated at the retained outputs only
+    '''
+    def __init__(self, hRep, denominator, factor, inputBits=15, average=False):
+        '''!
+        @param hRep signed digit matrix (FIRfilterIntegerCoefficients.hDigits) or list of +/-2^k terms per tap
+        @param denominator power of two returned by FIRfilterIntegerCoefficients
+        @param factor decimation factor
+        @param inputBits fractional bits of the integer samples
+        @param average fuse the ones(FACTOR)/FACTOR averager of DecimatingShiftAddFIR
+        '''
+        gr.decim_block.__init__(
+            self, name='SparseFIRDecimatorCCF', in_sig=[np.complex64], out_sig=[np.complex64], decim=factor
+        )
+        ## Polyphase engine shared by the I and Q channels
+        self.decimator = DecimatingShiftAddFIR(hRep, denominator, factor, average=average)
+        # the window of work() starts NTAPS-1 samples before the first new input
+        self.set_history(self.decimator.numTaps)
+        self._io = _IntegerIO(inputBits, np.int64)
+
+    def work(self, input_items, output_items):
+        x, y = input_items[0], output_items[0]
+        n = len(y)
+        numIn = n * self.decimator.factor + self.decimator.numTaps - 1
+        for xi, part in zip(self._io.toInteger(x[:numIn]), (y.real, y.imag)):
+            # output m of the block is the full convolution output m * factor + NTAPS - 1 of the window
+            acc = self.decimator.outputs(xi, self.decimator.numTaps - 1, n, out=self._io.output(n))
+            self._io.toFloat(self.decimator.scale(acc, out=acc), part)
+        return n
+
+
+def main():
+    from gnuradio import blocks, filter
+    from gnuradio.filter import firdes
+
+    from FirTapsToInteger import FIRfilterIntegerCoefficients
+
+    numSamples = 1 << 22
+    factor = 8
+    hFIR = firdes.low_pass(1, 1, 0.5 / factor - 0.02, 0.04)
+    convertor = FIRfilterIntegerCoefficients(maxBitSetSize=6, maxBitWidth=24, errorTarget=1e-3)
+    b, a = convertor(hFIR)
+    taps = list(np.array(b) / a)
+    candidates = [
+        ('fir_filter_ccf', lambda: filter.fir_filter_ccf(1, taps)),
+        ('SparseFIRFilterCCF', lambda: SparseFIRFilterCCF(convertor.hDigits, a)),
+        (f'fir_filter_ccf decim {factor}', lambda: filter.fir_filter_ccf(factor, taps)),
+        (f'SparseFIRDecimatorCCF {factor}', lambda: SparseFIRDecimatorCCF(convertor.hDigits, a, factor)),
+    ]
+    print(f'{len(taps)} taps, {int(np.count_nonzero(convertor.hDigits))} non-zero digits, {numSamples} samples')
+    # null source -> head -> filter -> null sink: the rate is bounded by the filter only
+    for name, make in candidates:
+        tb = gr.top_block()
+        src = blocks.null_source(gr.sizeof_gr_complex)
+        head = blocks.head(gr.sizeof_gr_complex, numSamples)
+        sink = blocks.null_sink(gr.sizeof_gr_complex)
+        tb.connect(src, head, make(), sink)
+        start = time.perf_counter()
+        tb.run()
+        elapsed = time.perf_counter() - start
+        print(f'{name:32s}: {numSamples / elapsed / 1e6:8.2f} MS/s in')
+
+
+if __name__ == "__main__":
+    main()
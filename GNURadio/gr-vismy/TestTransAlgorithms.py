@@ -1,20 +1,26 @@
 #!/usr/bin/env python
 
-from TransportOptimization import UniformSparseAssignment, NonUniformSparseAssignment, MinSubsetNearTargetSum
+from TransportOptimization import UniformSparseAssignment, NonUniformSparseAssignment, OptimalSparseAssignment, SparseAssignmentState, MinSubsetNearTargetSum
 from FirTapsToInteger import FIRfilterIntegerCoefficients
+from SignedPowerTable import SignedPowerTable
+from Instrumentation import GetMetrics
+from DesignCache import DesignCache, DesignKey
+from BatchQuantization import BatchQuantize
+from RepresentationCache import SparseRepresentationCache
+from ShiftAddFilter import ShiftAddFIR, StreamingShiftAddFIR, DecimatingShiftAddFIR
+from AdderGraph import AdderGraphFIR
+from SparseAllocation import HeapGreedyAllocation, UniformSparseAllocation, HybridSparseAllocation, SparseBudgetSweep, MinimumSparseBudget, FrequencyResponseAllocation, ResponseMatrix, ResponseScores, CascadeResponse, CascadeSparseAllocation
+import os
+import subprocess
+import sys
+import tempfile
 import numpy as np
-from gnuradio.filter import firdes as fir
-from matplotlib import pyplot as plt
 
 def main_nusa(hCoeffs, sparseBudget, reqBits):
     # hCoeffs = [51, 24, 11, 39, 1, 27, 17, 61, 49, 18]
     # sparseBudget = 27
     nusa = [NonUniformSparseAssignment(i,el) for i,el in enumerate(hCoeffs)]
-
-    for s in range(sparseBudget):
-        getCost = [nusa[i].cost for i in range(len(nusa))]
-        idx = np.argmax(np.array(getCost))
-        nusa[idx](numBits = reqBits)
+    HeapGreedyAllocation(nusa, sparseBudget, numBits = reqBits)
     
     for i in range(len(hCoeffs)):
         print(str(nusa[i]))
@@ -62,95 +68,469 @@ def main_unsa(hCoeffs, sparseBudget, reqBits, boundary=None):
 def main_hysa(hCoeffs, sparseBudget, reqBits, boundary=None):
     # hCoeffs = [51, 24, 11, 39, 1, 27, 17, 61, 49, 18]
     # sparseBudget = 27
-    print(''*40 + f'BOUNDARY:{boundary}')
-    b = len(hCoeffs) if boundary==None else int(boundary)
-    hIdList = np.argsort(np.abs(hCoeffs))[-b:]
-    hysa = [UniformSparseAssignment(i,el) for i,el in enumerate(hCoeffs)]
+    with GetMetrics().run(f'hysa boundary={boundary}') as report:
+        hysa = HybridSparseAllocation(hCoeffs, sparseBudget, numBits=reqBits, boundary=boundary)
+    print('-'*5)
+    print(f'Total Cost HYSA: {hysa.totalCost} \t Exchanges = {hysa.numExchanges} \t Num of Calls = {hysa.numCalls}')
+    print(report)
+    print('-'*5)
 
-    q = sparseBudget//b
-    r = sparseBudget%b
+def main_boundary(hCoeffs, sparseBudget, reqBits):
+    # A boundary beyond the number of taps covers every tap, as boundary=None does
+    for h, budget, numBits in (([51, 24, 11, 39, 1], 14, 6), (hCoeffs, sparseBudget, reqBits)):
+        for allocator in (UniformSparseAllocation, HybridSparseAllocation):
+            every = allocator(h, budget, numBits=numBits)
+            for boundary in (len(h), len(h) + 2, 2 * len(h) + 1):
+                result = allocator(h, budget, numBits=numBits, boundary=boundary)
+                assert np.array_equal(result.assgn, every.assgn), f'{allocator.__name__} boundary {boundary} of {len(h)} taps: {result.assgn}'
+    print('-'*5)
+    print(f'Boundary beyond {len(hCoeffs)} taps: UNSA {UniformSparseAllocation(hCoeffs, sparseBudget, numBits=reqBits, boundary=len(hCoeffs) + 2).budget} '
+          f'HYSA {HybridSparseAllocation(hCoeffs, sparseBudget, numBits=reqBits, boundary=len(hCoeffs) + 2).budget} units of {sparseBudget}')
+    print('-'*5)
 
-    if q:
-        for i in hIdList:
-            _r = hysa[i](q, numBits=reqBits)
-            if _r:
-                r+=_r
-
-    for s in range(r):
-        getCost = [hysa[i].cost for i in range(len(hysa))]
-        idx = np.argmax(np.array(getCost))
-        hysa[idx](maxBitSetSize = hysa[idx].assgn+1, numBits = reqBits)
-
-    # THERE IS A NEED FOR EXCHANGE IN THIS STEP
-        #   a. Find the coeff with the minimum absolute value
-        #   b. Move the Sparse Weight to the Coeff with Highest Cost
-        #   c. Criteria for Exchange Needs a Review
-    prevCost = 0
-    for i in range(len(hCoeffs)):
-            prevCost += hysa[i].cost
-    FromList = []
-    NO_EXC_FLAG = False
+def main_osa(hCoeffs, sparseBudget, reqBits):
+    # Provably minimal total cost, the reference for the NUSA/UNSA/HYSA heuristics
+    osa = OptimalSparseAssignment(hCoeffs)
+    osa(sparseBudget, numBits=reqBits)
+    print('-'*5)
+    print(f'Total Cost OSA: {osa.totalCost} \t Budget Used = {np.sum(osa.assgn)}')
+    print('-'*5)
+
+def main_state(hCoeffs, sparseBudget, reqBits):
+    # Array-backed NUSA: same allocation as the per-tap objects of main_nusa
+    state = SparseAssignmentState(hCoeffs, numBits=reqBits)
     for _ in range(sparseBudget):
-        minAbsCoeff = [np.min(np.abs(_h._hRep)) if _h._hRep else np.Inf for _h in hysa]
-        getCost = [hysa[i].cost for i in range(len(hysa))]
-        FromList = np.where(minAbsCoeff == np.min(minAbsCoeff))[0].tolist()
-        fromIdx = FromList.pop()
-        print(f'FromList: {FromList}, and Index: {fromIdx}')
-        toIdx = np.argmax(getCost)
-        print(f'fid:{fromIdx} and tid:{toIdx}')
-        CONT_FLAG = True
-        # return to this place if p>prevCost and if FromList is non empty
-        while CONT_FLAG:
-            if (hysa[fromIdx].cost < hysa[toIdx].cost) & (fromIdx!=toIdx) & (hysa[fromIdx].assgn!=0):
-                # Dummy objects created
-                dummyHYSA = [UniformSparseAssignment(fromIdx, hCoeffs[fromIdx]), UniformSparseAssignment(toIdx, hCoeffs[toIdx])]
-                dummyHYSA[0](maxBitSetSize = hysa[fromIdx].assgn-1, numBits = reqBits)
-                dummyHYSA[1](maxBitSetSize = hysa[toIdx].assgn+1, numBits = reqBits)
-                dSum = dummyHYSA[0].cost + dummyHYSA[1].cost
-                # Total Cost with the Dummy Cost
-                #
-                p = 0
-                for i in np.delete(np.arange(len(hCoeffs)), [fromIdx, toIdx]):
-                    p += hysa[i].cost
-                p += dSum
-                print(f'Current TEST Cost: {p}')
-
-                if p < prevCost:
-                # if DELTA FROM IDX cost is less than DELTA TO IDX cost then move -- but this will require some effort
-                    print('EXCHANGE DONE')
-                    hysa[fromIdx](maxBitSetSize = hysa[fromIdx].assgn-1, numBits = reqBits)
-                    hysa[toIdx](maxBitSetSize = hysa[toIdx].assgn+1, numBits = reqBits)
-                    prevCost = p
-                    CONT_FLAG = False
-                else:
-                    print('NO EXCHANGE')
-                    if FromList:
-                        fromIdx = FromList.pop()
-                        CONT_FLAG = True
-                    else:
-                        NO_EXC_FLAG = True
-                        break
-                #
-            else:
-                print('NO EXCHANGE')
-                NO_EXC_FLAG = True
-                break
-        if NO_EXC_FLAG:
-            break
+        state.increment(state.argmax())
+    nusa = [NonUniformSparseAssignment(i, el) for i, el in enumerate(hCoeffs)]
+    HeapGreedyAllocation(nusa, sparseBudget, numBits=reqBits)
+    assert state.hRep == [list(tap._hRep) for tap in nusa]
+    assert state.totalCost == sum(tap.cost for tap in nusa)
+    # the batched cost table holds the representation of every tap for every k
+    hApp, cost, rep = state.costTable()
+    table = SparseAssignmentState(hCoeffs, numBits=reqBits)
+    table.assignFromTable((hApp, cost, rep), np.arange(len(table)), state.assgn)
+    assert table.hRep == state.hRep and np.array_equal(cost[np.arange(len(state)), state.assgn], state.cost)
+    # UNSA read from the cost table: the same taps as searched one assignment call at a time
+    b = len(hCoeffs) // 2
+    q, r = divmod(sparseBudget, b)
+    searched = SparseAssignmentState(hCoeffs, numBits=reqBits)
+    largest = np.argsort(np.abs(searched.h), kind='stable')[len(searched) - b:]
+    searched.assign(largest, q)
+    searched.assign(largest[np.argsort(searched.cost[largest], kind='stable')[-r:]], q + 1)
+    unsa = UniformSparseAllocation(hCoeffs, sparseBudget, numBits=reqBits, boundary=b)
+    assert unsa.hRep == searched.hRep and np.array_equal(unsa.cost, searched.cost)
+    print(state)
 
+def main_fsa(hFIR, sparseBudget, reqBits):
+    # Budget spent on the peak frequency response error instead of the sum of the tap costs
+    hTarget = np.asarray(hFIR) / 2**-reqBits
+    E, _ = ResponseMatrix(len(hTarget))
+    nusa = [NonUniformSparseAssignment(i, el) for i, el in enumerate(np.round(hTarget))]
+    nusaPeak = np.max(np.abs(E @ (HeapGreedyAllocation(nusa, sparseBudget, numBits=reqBits).hApp - hTarget)))
+    fsa = FrequencyResponseAllocation(hTarget, sparseBudget, numBits=reqBits)
+    # the closed form scores of the moves match the moved responses
+    R = E @ (np.round(hTarget) - hTarget)
+    taps = np.arange(0, len(hTarget), 2)
+    d = np.linspace(-3, 3, len(taps))
+    for order in (2, 4):
+        direct = np.sum(np.abs(R[:, None] + E[:, taps] * d)**order, axis=0)
+        assert np.allclose(ResponseScores(R, E, d, taps, order, E * E), direct, rtol=1e-9)
+    print('-'*5)
+    print(f'Peak Response Error FSA: {fsa.responseError} \t NUSA: {nusaPeak} \t Budget Used = {fsa.budget}')
+    print('-'*5)
 
-    for i in range(len(hCoeffs)):
-            print(str(hysa[i]))
-    #
-    p = 0
-    for i in range(len(hCoeffs)):
-            p = UniformSparseAssignment.acc(hysa[i].numCalls, p)
+def main_cascade(hStages, rates, sparseBudget, reqBits):
+    # One budget split over the stages of a decimation chain on the composite response, against budgets proportional to the taps
+    numTaps = [len(h) for h in hStages]
+    split = [sparseBudget * n // sum(numTaps) for n in numTaps]
+    split[-1] += sparseBudget - sum(split)
+    hSplit = [FrequencyResponseAllocation(np.asarray(h) / 2**-reqBits, b, numBits=reqBits).hApp * 2.0**-reqBits for h, b in zip(hStages, split)]
+    target, _ = CascadeResponse(hStages, rates)
+    splitPeak = np.max(np.abs(CascadeResponse(hSplit, rates)[0] - target))
+    joint = CascadeSparseAllocation(hStages, sparseBudget, numBits=reqBits, rates=rates)
+    assert joint.responseError <= splitPeak
+    print('-'*5)
+    print(f'Composite Peak Error Joint: {joint.responseError} {joint.stageBudgets} \t Split: {splitPeak} {split}')
+    print(f'Smallest joint budget meeting the split error: {MinimumSparseBudget(joint.budgetCost, splitPeak)}')
+    # two identical stages: the joint split is no worse than the best equal split
+    twin = [hStages[0]] * 2
+    target, _ = CascadeResponse(twin)
+    equalPeak = min(
+        np.max(np.abs(CascadeResponse([FrequencyResponseAllocation(np.asarray(twin[0]) / 2**-reqBits, b, numBits=reqBits).hApp * 2.0**-reqBits] * 2)[0] - target))
+        for b in range(1, sparseBudget // 2 + 1)
+    )
+    joint = CascadeSparseAllocation(twin, sparseBudget, numBits=reqBits)
+    assert joint.responseError <= equalPeak
+    print(f'Identical stages Joint: {joint.responseError} {joint.stageBudgets} \t Best Equal: {equalPeak}')
+    print('-'*5)
+
+def main_sweep(hCoeffs, maxBudget, reqBits, targetCost):
+    # Cost versus budget curve of the whole filter in one run
+    for method in ['nusa', 'optimal']:
+        budgetCost = SparseBudgetSweep(hCoeffs, maxBudget, numBits=reqBits, method=method)
+        print('-'*5)
+        print(f'{method.upper()} cost per budget: {budgetCost}')
+        print(f'Smallest budget with cost <= {targetCost}: {MinimumSparseBudget(budgetCost, targetCost)}')
+        print('-'*5)
+
+def main_csd(numBits=6, maxBitSetSizes=(1, 2, 3)):
+    # Equivalence of the signed digit encoder with the exhaustive subset search
+    searchSet = [2**i for i in range(numBits + 1)] + [-(2**i) for i in range(numBits + 1)]
+    hValues = [v for v in range(-2**numBits, 2**numBits + 1) if v != 0]
+    digits = FIRfilterIntegerCoefficients.CanonicalSignedDigits(hValues, numBits)
+    convertor = FIRfilterIntegerCoefficients()
+    for i, val in enumerate(hValues):
+        minSubSet = FIRfilterIntegerCoefficients.MinSubsetOfTargetSum(searchSet, 2*(numBits+1), val, 2*(numBits+1))
+        weight = np.count_nonzero(digits[i])
+        assert weight == len(minSubSet), f'{val}: CSD weight {weight} != search weight {len(minSubSet)}'
+    for maxBitSetSize in maxBitSetSizes:
+        sparse = convertor.sparseDigits(hValues, numBits, maxBitSetSize)
+        hTruncated = FIRfilterIntegerCoefficients.SignedDigitsToInteger(sparse)
+        assert np.all(np.count_nonzero(sparse, axis=1) <= maxBitSetSize)
+        for i, val in enumerate(hValues):
+            bfSubSet = FIRfilterIntegerCoefficients.MinSubsetOfTargetSum(searchSet, 2*(numBits+1), val, maxBitSetSize)
+            assert abs(val - hTruncated[i]) <= abs(val - sum(bfSubSet)), f'{val}: CSD {hTruncated[i]} worse than search {sum(bfSubSet)}'
+            if np.count_nonzero(digits[i]) <= maxBitSetSize:
+                assert hTruncated[i] == val
+    print('-'*5)
+    print(f'CSD encoder matches or beats subset search for {len(hValues)} values at {numBits} bits, k = {maxBitSetSizes}')
+    print('-'*5)
+
+def main_table(numBitsList=(4, 6, 8), maxBitSetSizes=(1, 2, 3)):
+    # The signed power table gives the cost of the exhaustive MinSubsetNearTargetSum, the subset may differ on ties
+    numValues = 0
+    for numBits in numBitsList:
+        searchSet = [2**i for i in range(numBits + 1)] + [-(2**i) for i in range(numBits + 1)]
+        # integers and half-integers, which tie between two subsets
+        hValues = np.arange(-2**(numBits + 1), 2**(numBits + 1) + 1, 2**max(0, numBits - 5) + 0.5)
+        for k in maxBitSetSizes:
+            table = SignedPowerTable(k, numBits)
+            for val in hValues:
+                exact = abs(val - sum(MinSubsetNearTargetSum(searchSet, len(searchSet), val, k)))
+                subset = table(val)
+                assert len(subset) <= k and abs(val - sum(subset)) == exact, f'table cost differs at {val}, k = {k}, numBits = {numBits}'
+            numValues += len(hValues)
+    print('-'*5)
+    print(f'Signed power table: cost of MinSubsetNearTargetSum on {numValues} values, numBits {numBitsList}, k {maxBitSetSizes}')
+    print('-'*5)
+
+def main_subset(exponents=(0, 1, 3, 4, 6, 8), odd=(1, 3), maxBitSetSize=3):
+    # Branch-and-bound subset search on a custom shift set (odd multiples of restricted exponents) against the exhaustive one
+    searchSet = [o * 2**e for e in exponents for o in odd]
+    searchSet += [-x for x in searchSet]
+    hValues = range(-3 * 2**max(exponents), 3 * 2**max(exponents) + 1, 37)
+    with GetMetrics().run('exhaustive') as exhaustive:
+        exact = [MinSubsetNearTargetSum(searchSet, len(searchSet), val, maxBitSetSize) for val in hValues]
+    with GetMetrics().run('branch') as branch:
+        bnb = [MinSubsetNearTargetSum(searchSet, len(searchSet), val, maxBitSetSize, method='branch') for val in hValues]
+    assert exact == bnb
+    visited, pruned = branch.counters['candidatesEvaluated'], branch.counters.get('candidatesPruned', 0)
+    print('-'*5)
+    print(f'Subset search over {len(searchSet)} shifts: exhaustive {exhaustive.counters["candidatesEvaluated"]} candidates '
+          f'{exhaustive.wallTime:.3f} s \t branch-and-bound {visited} visited, {pruned} pruned {branch.wallTime:.3f} s')
+    print('-'*5)
+
+def main_width(hFIR, errorTarget, maxBitSetSize=8, maxBitWidth=24):
+    # Smallest bit width (then set bits per tap) meeting the tap error target, against the log2(min|h|) rule
+    convertor = FIRfilterIntegerCoefficients(maxBitSetSize=maxBitSetSize, maxBitWidth=maxBitWidth, errorTarget=errorTarget)
+    convertor(hFIR)
+    width, bitSetSize = convertor.bitWidth, convertor.bitSetSize
+    assert convertor.tapError(hFIR, width, bitSetSize) <= errorTarget
+    assert all(convertor.tapError(hFIR, w, maxBitSetSize) > errorTarget for w in range(width))
+    assert all(convertor.tapError(hFIR, width, k) > errorTarget for k in range(1, bitSetSize))
+    # the error is not monotone in the width: random low-passes, every width below the result misses the target
+    rng = np.random.default_rng(19)
+    for _ in range(20):
+        numTaps = int(rng.integers(9, 80)) | 1
+        n = np.arange(numTaps) - numTaps // 2
+        cutoff = rng.uniform(0.05, 0.4)
+        h = np.sinc(2 * cutoff * n) * np.hamming(numTaps)
+        h /= np.sum(h)
+        for k in (2, 3):
+            target = float(rng.choice([1e-2, 3e-3, 1e-3]))
+            check = FIRfilterIntegerCoefficients(maxBitSetSize=k, maxBitWidth=maxBitWidth, errorTarget=target)
+            try:
+                w, _ = check.SearchBitWidth(h, target)
+            except ValueError:
+                # no width meets the target with k set bits
+                w = maxBitWidth + 1
+            assert all(check.tapError(h, v, k) > target for v in range(w)), (numTaps, k, target, w)
+    print('-'*5)
+    print(f'Error Target {errorTarget}: Width = {width} \t Set Bits = {bitSetSize} \t log2(min|h|) Width = {int(-np.floor(np.log2(np.min(np.abs(hFIR)))))}')
+    print('-'*5)
+
+def main_batch(numFilters=11, workers=3, chunkSize=3):
+    # BatchQuantize in a process pool, with an odd chunk size, gives the serial results in the order of the bank
+    rng = np.random.default_rng(7)
+    def lowPass(numTaps, cutoff):
+        n = np.arange(numTaps) - numTaps // 2
+        h = np.sinc(2 * cutoff * n) * np.hamming(numTaps)
+        return h / np.sum(h)
+    listBank = [lowPass(int(rng.integers(9, 80)) | 1, rng.uniform(0.05, 0.4)) for _ in range(numFilters)]
+    arrayBank = np.array([lowPass(41, cutoff) for cutoff in rng.uniform(0.05, 0.4, numFilters)])
+    def same(a, b):
+        return len(a) == len(b) and all(np.array_equal(x[0], y[0]) and x[1] == y[1] for x, y in zip(a, b))
+    for bank in (listBank, arrayBank):
+        for params in ({'maxBitSetSize': 2, 'maxBitWidth': 24}, {'maxBitSetSize': 6, 'maxBitWidth': 24, 'errorTarget': 1e-3}):
+            serial = BatchQuantize(bank, workers=1, **params)
+            parallel = BatchQuantize(bank, workers=workers, chunkSize=chunkSize, **params)
+            assert same(serial, parallel), f'{type(bank).__name__} bank differs with {workers} workers'
+            convertor = FIRfilterIntegerCoefficients(**params)
+            assert same(serial, [convertor(h) for h in bank])
+    print('-'*5)
+    print(f'Batch quantization: {numFilters} filters as a list and as a 2-D array, {workers} workers with chunks of {chunkSize} equal the serial run')
+    print('-'*5)
+
+def main_blocks(hFIR, factor, numSamples=5000, inputBits=15):
+    # The GNU Radio blocks, called over uneven work() chunks, against np.convolve with hTruncated / denominator
+    from SparseFilterBlocks import SparseFIRDecimatorCCF, SparseFIRFilterCCF
+    convertor = FIRfilterIntegerCoefficients(maxBitSetSize=6, maxBitWidth=24, errorTarget=1e-3)
+    hTruncated, denominator = convertor(hFIR)
+    taps = np.array(hTruncated) / denominator
+    rng = np.random.default_rng(20)
+    x = (0.5 * (rng.standard_normal(numSamples) + 1j * rng.standard_normal(numSamples)) / 3).astype(np.complex64)
+    # bit-true reference: integer samples, integer taps, final right shift
+    scale = 2.0**inputBits
+    xi = [np.clip(np.rint(part.astype(np.float64) * scale), -scale, scale).astype(np.int64) for part in (x.real, x.imag)]
+    shift = int(np.log2(denominator))
+    def reference(step):
+        parts = [np.right_shift(np.convolve(p, np.array(hTruncated, dtype=np.int64))[:numSamples:step], shift) / scale for p in xi]
+        return parts[0] + 1j * parts[1]
+    # rounding of the input and floor of the output, per I/Q part
+    bound = (0.5 * np.sum(np.abs(taps)) + 1) / scale + 1e-6
+
+    def chunks(total):
+        start = 0
+        while start < total:
+            n = min(int(rng.integers(1, 700)), total - start)
+            yield start, n
+            start += n
+
+    block = SparseFIRFilterCCF(convertor.hDigits, denominator, inputBits=inputBits)
+    y = np.empty(numSamples, dtype=np.complex64)
+    for start, n in chunks(numSamples):
+        assert block.work([x[start:start + n]], [y[start:start + n]]) == n
+    assert np.array_equal(y, reference(1))
+    exact = np.convolve(x.astype(np.complex128), taps)[:numSamples]
+    assert np.max(np.abs(y.real - exact.real)) <= bound and np.max(np.abs(y.imag - exact.imag)) <= bound
+    syncError = np.max(np.abs(y - exact))
+
+    decimator = SparseFIRDecimatorCCF(convertor.hDigits, denominator, factor, inputBits=inputBits)
+    numOut = numSamples // factor
+    # the scheduler keeps NTAPS-1 samples of history in front of every work() window
+    history = np.concatenate([np.zeros(decimator.decimator.numTaps - 1, dtype=np.complex64), x])
+    y = np.empty(numOut, dtype=np.complex64)
+    for start, n in chunks(numOut):
+        window = history[start * factor:start * factor + n * factor + decimator.decimator.numTaps - 1]
+        assert decimator.work([window], [y[start:start + n]]) == n
+    assert np.array_equal(y, reference(factor)[:numOut])
+    exact = exact[::factor][:numOut]
+    assert np.max(np.abs(y.real - exact.real)) <= bound and np.max(np.abs(y.imag - exact.imag)) <= bound
+    print('-'*5)
+    print(f'Sparse blocks bit-true over uneven work() calls: sync max error {syncError:.2e} \t decim {factor} max error {np.max(np.abs(y - exact)):.2e} \t bound {bound:.2e}')
+    print('-'*5)
+
+def main_shift_add(hFIR, inputBits=15):
+    # ShiftAddFIR is bit-true against the integer convolution with hTruncated, shifted by log2(denominator)
+    convertor = FIRfilterIntegerCoefficients(maxBitSetSize=6, maxBitWidth=24, errorTarget=1e-3)
+    hTruncated, denominator = convertor(hFIR)
+    filter = ShiftAddFIR(convertor.hDigits, denominator)
+    h = np.array(hTruncated, dtype=np.int64)
+    assert np.array_equal(filter.hInteger, h)
+    shift = int(np.log2(denominator))
+    rng = np.random.default_rng(8)
+    # longer and shorter than the filter, which swaps the roles in 'same' and 'valid'
+    for numSamples in (3000, len(h) // 2, 1):
+        xr, xi = rng.integers(-2**inputBits, 2**inputBits, (2, numSamples))
+        for mode in ('full', 'same', 'valid'):
+            expected = np.convolve(xr, h, mode) >> shift
+            assert np.array_equal(filter(xr, mode), expected), f'{mode} differs for {numSamples} samples'
+            y = filter(xr + 1j * xi, mode)
+            assert np.array_equal(y.real, expected) and np.array_equal(y.imag, np.convolve(xi, h, mode) >> shift), f'complex {mode} differs'
+    # trailing axes are channels filtered in the same pass
+    x = rng.integers(-2**inputBits, 2**inputBits, (3000, 3))
+    y = filter(x, 'same')
+    assert all(np.array_equal(y[:, c], np.convolve(x[:, c], h, 'same') >> shift) for c in range(3))
+    # speed against np.convolve on the float samples, real and complex
+    x = rng.integers(-2**inputBits, 2**inputBits, (2, 500000))
+    timings = {}
+    for name, xt, xf in (('real', x[0], x[0].astype(np.float64)), ('complex', x[0] + 1j * x[1], x[0] + 1j * x[1])):
+        with GetMetrics().run('shiftadd') as shiftAdd:
+            filter(xt)
+        with GetMetrics().run('convolve') as convolve:
+            np.convolve(xf, hFIR)
+        timings[name] = convolve.wallTime / shiftAdd.wallTime
+    numDigits = np.count_nonzero(filter.hDigits)
     print('-'*5)
-    getCost = [hysa[i].cost for i in range(len(hysa))]
-    print(f'Total Cost HYSA: {np.sum(np.array(getCost))} \t Num of Calls = {p}')
+    print(f'Shift-add FIR bit-true against np.convolve >> {shift}: {len(h)} taps, {filter.numAdditions} additions per sample, full/same/valid, real and complex')
+    print(f'{numDigits / len(h):.2f} digits per tap, speedup over np.convolve: real {timings["real"]:.2f}x, complex {timings["complex"]:.2f}x')
+    print('-'*5)
+
+def main_decimate(hFIR, factors=(8, 3, 5), numSamples=140001, inputBits=15):
+    # DecimatingShiftAddFIR against np.convolve(ones(D), h) taken at [D-1::D], shifted and floor divided by D,
+    # on a signal spanning several blocks of the polyphase pass
+    convertor = FIRfilterIntegerCoefficients(maxBitSetSize=6, maxBitWidth=24, errorTarget=1e-3)
+    hTruncated, denominator = convertor(hFIR)
+    h = np.array(hTruncated, dtype=np.int64)
+    shift = int(np.log2(denominator))
+    rng = np.random.default_rng(10)
+    xr, xi = rng.integers(-2**inputBits, 2**inputBits, (2, numSamples))
+    for D in factors:
+        for average in (True, False):
+            decimator = DecimatingShiftAddFIR(convertor.hDigits, denominator, D, average=average)
+            composite = np.convolve(np.ones(D, dtype=np.int64), h) if average else h
+            assert decimator.numTaps == len(composite)
+            def expected(x, mode):
+                full = np.convolve(x, composite) >> shift
+                if average:
+                    # a power of two divides by one more shift, other factors by a floor division
+                    full = np.floor_divide(full, D)
+                first = D - 1 if mode == 'full' else len(composite) - 1 + (D - len(composite) % D) % D
+                return full[first:len(full) if mode == 'full' else numSamples:D]
+            for mode in ('full', 'valid'):
+                assert np.array_equal(decimator(xr, mode), expected(xr, mode)), f'factor {D} average {average} {mode} differs'
+            y = decimator(xr + 1j * xi, 'full')
+            assert np.array_equal(y.real, expected(xr, 'full')) and np.array_equal(y.imag, expected(xi, 'full'))
+    # speed against the full-rate chain: sparse filter, running sum, keep one output in D
+    D = factors[0]
+    x = np.tile(xr, 8)
+    full = ShiftAddFIR(convertor.hDigits, denominator)
+    decimator = DecimatingShiftAddFIR(convertor.hDigits, denominator, D)
+    fused, chain = [], []
+    for _ in range(3):
+        with GetMetrics().run('decimate') as report:
+            decimator(x)
+        fused.append(report.wallTime)
+        with GetMetrics().run('chain') as report:
+            acc = full.accumulate(x, np.zeros(len(x) + full.numTaps - 1, dtype=np.int64))
+            # running sums of D samples at the kept outputs D-1, 2D-1, ...
+            np.floor_divide(np.diff(np.cumsum(acc)[D - 1::D], prepend=0) >> shift, D)
+        chain.append(report.wallTime)
+    print('-'*5)
+    print(f'Decimating shift-add bit-true against np.convolve(ones(D), h)[D-1::D] for D in {factors}, with and without the averager')
+    print(f'Factor {D}, {len(h)} taps, {full.numAdditions + 1} digits, {len(x)} samples: fused {min(fused):.4f} s \t full-rate chain {min(chain):.4f} s \t speedup {min(chain) / min(fused):.1f}x')
+    print('-'*5)
+
+def main_adder_graph(hFIR, numSamples=3000, inputBits=15):
+    # The shared adder graph rebuilds the taps, and its filter is bit-true against ShiftAddFIR
+    rng = np.random.default_rng(11)
+    xr, xi = rng.integers(-2**inputBits, 2**inputBits, (2, numSamples))
+    print('-'*5)
+    for maxBitSetSize in (2, 4, 6):
+        convertor = FIRfilterIntegerCoefficients(maxBitSetSize=maxBitSetSize, maxBitWidth=16)
+        hTruncated, denominator = convertor(hFIR)
+        reference = ShiftAddFIR(convertor.hDigits, denominator)
+        shared = AdderGraphFIR(convertor.hDigits, denominator)
+        nodeValues, taps = shared.graph.values()
+        assert np.array_equal(taps, reference.hInteger), f'adder graph taps differ for k = {maxBitSetSize}'
+        for mode in ('full', 'same', 'valid'):
+            assert np.array_equal(shared(xr, mode), reference(xr, mode)), f'{mode} differs for k = {maxBitSetSize}'
+        assert np.array_equal(shared(xr + 1j * xi), reference(xr + 1j * xi))
+        stream = StreamingShiftAddFIR(shared, blockSize=1000)
+        y = [stream(xr[:1000])]
+        nodes = shared._nodes
+        y += [stream(xr[1000:2500]), stream(xr[2500:]), stream.flush()]
+        assert np.array_equal(np.concatenate(y), reference(xr))
+        # the node buffers of the streamed blocks are allocated once
+        assert shared._nodes is nodes
+        # the lower add count is a lower run time on a long signal
+        x = np.tile(xr, 200)
+        dtype = reference.accumulatorDtype(2**inputBits)
+        times = {}
+        for filter in (reference, shared, reference, shared):
+            with GetMetrics().run('adder graph') as report:
+                filter.accumulate(x.astype(dtype), np.zeros(len(x) + filter.numTaps - 1, dtype=dtype))
+            times[filter] = min(times.get(filter, np.inf), report.wallTime)
+        print(f'Adder graph k = {maxBitSetSize}: naive {shared.graph.naiveAdderCount} -> shared {shared.graph.adderCount} multiplier adders '
+              f'| additions per sample {reference.numAdditions} -> {shared.numAdditions} ({shared.numVectorAdditions} vector) | {len(nodeValues) - 1} nodes '
+              f'| {len(x)} samples {times[reference]:.4f} s -> {times[shared]:.4f} s')
+    print('-'*5)
+
+def main_stream(hFIR, numSamples=5000, blockSize=257):
+    # Random chunks through StreamingShiftAddFIR, then flush(), against ShiftAddFIR on the whole signal
+    convertor = FIRfilterIntegerCoefficients(maxBitSetSize=6, maxBitWidth=24, errorTarget=1e-3)
+    hTruncated, denominator = convertor(hFIR)
+    reference = ShiftAddFIR(convertor.hDigits, denominator)
+    rng = np.random.default_rng(9)
+    for dtype, inputBits in ((np.int32, 12), (np.int64, 24)):
+        x = rng.integers(-2**inputBits, 2**inputBits, numSamples)
+        assert reference.accumulatorDtype(2**inputBits) == dtype
+        stream = StreamingShiftAddFIR(convertor.hDigits, denominator, blockSize=blockSize, dtype=dtype)
+        y, start = [], 0
+        while start < numSamples:
+            # chunks shorter and longer than a block, and empty ones
+            n = min(int(rng.integers(0, 3 * blockSize)), numSamples - start)
+            y.append(stream(x[start:start + n]))
+            start += n
+        y.append(stream.flush())
+        assert np.array_equal(np.concatenate(y), reference(x)), f'{np.dtype(dtype).name} stream differs'
+        # the state is cleared by flush()
+        assert np.array_equal(np.concatenate([stream(x[:100]), stream.flush()]), reference(x[:100]))
+    print('-'*5)
+    print(f'Streaming shift-add: {len(y) - 1} chunks of up to {3 * blockSize - 1} samples, int32 and int64 accumulators equal ShiftAddFIR')
+    print('-'*5)
+
+def main_design_cache(hFIR, sparseBudget, reqBits):
+    # A repeated design is read back from the content addressed cache unchanged
+    with tempfile.TemporaryDirectory() as cacheDir:
+        cache = DesignCache(cacheDir)
+        built, _ = cache.quantize(hFIR)
+        loaded, _ = cache.quantize(hFIR)
+        assert built[0] == loaded[0] and built[1] == loaded[1]
+        hInteger, _ = FIRfilterIntegerCoefficients.convertTapsToInteger(hFIR)
+        built = cache.allocate(HybridSparseAllocation, hInteger, sparseBudget, numBits=reqBits)
+        loaded = cache.allocate(HybridSparseAllocation, hInteger, sparseBudget, numBits=reqBits)
+        assert built.hRep == loaded.hRep and built.totalCost == loaded.totalCost
+        # a representation cache changes the speed, not the design: every instance reads the same entry
+        hits = cache.hits
+        loaded = cache.allocate(HybridSparseAllocation, hInteger, sparseBudget, numBits=reqBits, cache=SparseRepresentationCache())
+        assert cache.hits == hits + 1 and loaded.hRep == built.hRep
+        # the response allocator takes the taps in the integer domain, as in main_fsa
+        hTarget = np.asarray(hFIR) / 2**-reqBits
+        built = cache.allocate(FrequencyResponseAllocation, hTarget, sparseBudget, numBits=reqBits)
+        loaded = cache.allocate(FrequencyResponseAllocation, hTarget, sparseBudget, numBits=reqBits)
+        fresh = FrequencyResponseAllocation(hTarget, sparseBudget, numBits=reqBits)
+        assert loaded.responseError == built.responseError == fresh.responseError
+        assert np.array_equal(loaded.assgn, fresh.assgn) and np.array_equal(loaded.hApp, fresh.hApp) and loaded.hRep == fresh.hRep
+        assert 0 < loaded.budget <= sparseBudget
+        # the key only depends on parameter values
+        assert DesignKey(hFIR, numBits=np.int64(reqBits)) == DesignKey(hFIR, numBits=reqBits)
+        try:
+            DesignKey(hFIR, cache=SparseRepresentationCache())
+            raise AssertionError('an object parameter must not be part of a key')
+        except TypeError:
+            pass
+        print('-'*5)
+        print(f'Design cache: {cache.hits} hits, {cache.misses} misses')
+        print('-'*5)
+
+def main_import():
+    # The NumPy-only core must import within its budget and without the demo dependencies
+    import SparseCore
+    code = (
+        'import sys, time; t = time.perf_counter(); import SparseCore; t = time.perf_counter() - t; '
+        'print(t, *[m for m in SparseCore.HEAVY_MODULES if m in sys.modules])'
+    )
+    # the child resolves SparseCore from this directory, wherever the checks are started from
+    out = subprocess.run(
+        [sys.executable, '-c', code], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    ).stdout.split()
+    importTime, heavy = float(out[0]), out[1:]
+    assert not heavy, f'SparseCore imported {heavy}'
+    assert importTime < SparseCore.IMPORT_TIME_BUDGET, f'import SparseCore took {importTime:.3f} s'
+    print('-'*5)
+    print(f'Import SparseCore: {importTime:.3f} s (budget {SparseCore.IMPORT_TIME_BUDGET} s)')
     print('-'*5)
 
 if __name__ == "__main__":
+    # demo and plotting dependencies are only needed here
+    from gnuradio.filter import firdes as fir
+    from matplotlib import pyplot as plt
+
+    main_import()
+    main_csd()
+    main_subset()
+    main_table()
     g = 1
     t = 20
     fs = 250
@@ -180,5 +560,24 @@ if __name__ == "__main__":
     plt.show()
     # for b in range(9,sparseBudget+1):
     #     main_hysa(hInteger, sparseBudget, int(reqBits), boundary=b)
+    main_sweep(hInteger, sparseBudget, int(reqBits), targetCost=100)
     main_hysa(hInteger, sparseBudget, int(reqBits), boundary=Index)
+    main_boundary(hInteger, sparseBudget, int(reqBits))
     main_nusa(hInteger, sparseBudget, int(reqBits))
+    main_osa(hInteger, sparseBudget, int(reqBits))
+    main_state(hInteger, sparseBudget, int(reqBits))
+    main_fsa(hFIR, sparseBudget, int(reqBits))
+    # the same low-pass as a decimate-by-2 chain of two short stages
+    hStages = [
+        fir.low_pass(gain=g, sampling_freq=fs, cutoff_freq=fs / 4 - t, transition_width=2 * t),
+        fir.low_pass(gain=g, sampling_freq=fs / 2, cutoff_freq=fs / factor - t / 2, transition_width=t),
+    ]
+    main_cascade(hStages, [1, 2], 2 * sparseBudget, 10)
+    main_design_cache(hFIR, sparseBudget, int(reqBits))
+    main_shift_add(hFIR)
+    main_stream(hFIR)
+    main_decimate(hFIR)
+    main_adder_graph(hFIR)
+    main_blocks(hFIR, factor)
+    main_batch()
+    main_width(hFIR, errorTarget=1e-3)
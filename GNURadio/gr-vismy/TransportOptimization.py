@@ -7,8 +7,12 @@
 #
 
 from FirTapsToInteger import FIRfilterIntegerCoefficients
+from Instrumentation import GetMetrics
+from RepresentationCache import GetRepresentationCache
+from SignedPowerTable import ExponentsToTerms, MasksToExponents, SignedPowerTable
 import numpy as np
 import itertools as it
+import math
 
 
 ''' 
@@ -38,9 +42,11 @@ class UniformSparseAssignment(object):
     '''!
             Sparsity budget is uniformly distributed among the filter coefficients
     '''
-    def __init__(self, id, hCoeff):
+    def __init__(self, id, hCoeff, cache=None):
         ##
         self.name = f'coeff_{id}'
+        ## Representation cache shared with the other taps (and filters) of the design
+        self.cache = cache if cache is not None else GetRepresentationCache()
         ## Exact Filter Coefficient
         self.h = hCoeff
         ## Approximate Filter Coefficient
@@ -56,8 +62,7 @@ class UniformSparseAssignment(object):
 
     def __call__(self, maxBitSetSize, numBits=6):
         self._numCalls += 1
-        searchSet = [2**i for i in range(numBits + 1)] + [-(2**i) for i in range(numBits + 1)]
-        self._hRep = MinSubsetNearTargetSum(searchSet, 2*(numBits+1), self.h, maxBitSetSize) if maxBitSetSize>0 else []
+        self._hRep = self.cache.lookup(self.h, maxBitSetSize, numBits)[0] if maxBitSetSize>0 else []
         self._hApp = np.sum(np.array(self._hRep)) if self._hRep else None
         self.assgn = len(self._hRep)
         self.cost
@@ -66,6 +71,16 @@ class UniformSparseAssignment(object):
         else:
             return 0
 
+    def assignTerms(self, terms):
+        '''!
+        @brief Take the representation TERMS read from a cost table instead of searched again, one call
+        '''
+        self._numCalls += 1
+        self._hRep = list(terms)
+        self._hApp = np.sum(np.array(self._hRep)) if self._hRep else None
+        self.assgn = len(self._hRep)
+        self.cost
+
     @property
     def cost(self):
         if self._hApp:
@@ -98,9 +113,11 @@ class NonUniformSparseAssignment(object):
     '''!
             Given sparsity budget is distributed across the filter taps to minimize the overall cost function
     '''
-    def __init__(self, id, hCoeff):
+    def __init__(self, id, hCoeff, cache=None):
         ##
         self.name = f'coeff_{id}'
+        ## Representation cache shared with the other taps (and filters) of the design
+        self.cache = cache if cache is not None else GetRepresentationCache()
         ## Exact Filter Coefficient
         self.h = hCoeff
         ## Approximate Filter Coefficient
@@ -123,12 +140,21 @@ class NonUniformSparseAssignment(object):
     def __call__(self, numBits=6):
         self._numCalls += 1
         maxBitSetSize = self.assgn + 1
-        searchSet = [2**i for i in range(numBits + 1)] + [-(2**i) for i in range(numBits + 1)]
-        self._hRep = MinSubsetNearTargetSum(searchSet, 2*(numBits+1), self.h, maxBitSetSize)
+        self._hRep = self.cache.lookup(self.h, maxBitSetSize, numBits)[0]
         self._hApp = np.sum(np.array(self._hRep))
         self.assgn = len(self._hRep)
         self.cost
 
+    def assignTerms(self, terms):
+        '''!
+        @brief Take the representation TERMS read from a cost table instead of searched again, one call
+        '''
+        self._numCalls += 1
+        self._hRep = list(terms)
+        self._hApp = np.sum(np.array(self._hRep)) if self._hRep else None
+        self.assgn = len(self._hRep)
+        self.cost
+
     @property
     def cost(self):
         if self._hApp:
@@ -164,21 +190,331 @@ class NonUniformSparseAssignment(object):
     def __str__(self):
         return f'{self.name:8s}: {str(self.h):10s} --- Usage: {str(self.assgn):3s} | hApp: {self.hApp:6s} | Rep: {self.hRep:25s} | Cost: {self.cost}'
 
-def MinSubsetNearTargetSum(set, n, val, maxBitSetSize):
+class SparseAssignmentState(object):
+    '''!
+            Sparse assignment of all the taps of a filter held in arrays, one entry per tap
+
+    A replacement of the lists of UniformSparseAssignment/NonUniformSparseAssignment
+    objects for large designs: the coefficients, approximations, assignment counts and
+    costs are NumPy arrays and the representations a fixed-width int8 matrix of signed
+    exponents (see MasksToExponents), so a 10k-tap design takes a few hundred kB and the
+    bulk operations (total cost, argmax, exchange candidates) are single vectorized calls.
+    '''
+    def __init__(self, hCoeffs, numBits=6, width=None, cache=None, kmax=None):
+        ## Exact Filter Coefficients
+        self.h = np.asarray(hCoeffs, dtype=np.float64).reshape(-1)
+        ## Largest shift of the search set
+        self.numBits = numBits
+        ## Representation cache shared with the other assignment objects
+        self.cache = cache if cache is not None else GetRepresentationCache()
+        ## Approximate Filter Coefficients
+        self.hApp = np.zeros(len(self.h), dtype=np.int64)
+        ## Number of shift assignments of every tap
+        self.assgn = np.zeros(len(self.h), dtype=np.int8)
+        ## Absolute cost of every tap; |h| to start with
+        self.cost = np.abs(self.h)
+        ## Largest number of assignments of a tap, by default the number beyond which the cost of no tap decreases; larger requests are clipped to it
+        self.kmax = OptimalSparseAssignment.RequiredBitSetSize(self.h, numBits)
+        if kmax is not None:
+            self.kmax = min(self.kmax, kmax)
+        ## Signed exponents +/-(i + 1) of the terms +/-2^i of every tap, 0 for unused columns
+        self.rep = np.zeros((len(self.h), self.kmax if width is None else width), dtype=np.int8)
+        ## Number of calls for optimization
+        self._numCalls = 0
+
+    def __len__(self):
+        return len(self.h)
+
+    def assign(self, taps, maxBitSetSize):
+        '''!
+        @brief Give the taps TAPS their best representation with at most MAX_BIT_SET_SIZE terms
+
+        @param taps tap indices (or a boolean mask)
+        @param maxBitSetSize number of terms, a scalar or one value per tap of TAPS
+        '''
+        taps = np.arange(len(self.h))[taps].reshape(-1)
+        sizes = np.broadcast_to(np.minimum(maxBitSetSize, min(self.kmax, self.rep.shape[1])), taps.shape)
+        self._numCalls += len(taps)
+        for k in np.unique(sizes):
+            sel = taps[sizes == k]
+            if k <= 0:
+                pos = neg = np.zeros(len(sel), dtype=np.int64)
+            else:
+                pos, neg = self.cache.masks(self.h[sel], int(k), self.numBits)
+            self.hApp[sel] = pos - neg
+            self.assgn[sel] = SignedPowerTable.PopCount(pos) + SignedPowerTable.PopCount(neg)
+            self.rep[sel] = MasksToExponents(pos, neg, self.rep.shape[1], self.numBits)
+        self.cost[taps] = np.abs(self.h[taps] - self.hApp[taps])
+
+    def costTable(self):
+        '''!
+        @brief Cost table of all the taps for k = 0 .. kmax assignments, see SparseRepresentationCache.costTable
+
+        @return (hApp, cost, rep)
+        '''
+        with GetMetrics().timer('costTable'):
+            return self.cache.costTable(self.h, self.kmax, self.numBits)
+
+    def assignFromTable(self, table, taps, maxBitSetSize):
+        '''!
+        @brief ASSIGN with the representations read from TABLE (from costTable) instead of searched again
+        '''
+        hApp, cost, rep = table
+        taps = np.arange(len(self.h))[taps].reshape(-1)
+        k = np.broadcast_to(np.minimum(maxBitSetSize, min(self.kmax, self.rep.shape[1])), taps.shape)
+        width = min(rep.shape[2], self.rep.shape[1])
+        self._numCalls += len(taps)
+        self.hApp[taps] = hApp[taps, k]
+        self.cost[taps] = cost[taps, k]
+        self.rep[taps] = 0
+        self.rep[taps, :width] = rep[taps, k, :width]
+        self.assgn[taps] = np.count_nonzero(self.rep[taps], axis=1)
+
+    def increment(self, taps):
+        '''!
+        @brief One more assignment for the taps TAPS, the NonUniformSparseAssignment step
+        '''
+        taps = np.arange(len(self.h))[taps].reshape(-1)
+        self.assign(taps, self.assgn[taps].astype(np.int64) + 1)
+
+    def argmax(self):
+        '''!
+        @brief Tap with the largest absolute cost, the next tap of the NUSA rule
+        '''
+        return int(np.argmax(self.cost))
+
+    def exchangeCandidates(self, costTable, k=None):
+        '''!
+        @brief Cost change of every tap for one assignment more and one assignment less
+
+        @param costTable cost of every tap for k = 0 .. kmax assignments (OptimalSparseAssignment.costTable)
+        @param k number of assignments of every tap; None uses ASSGN
+        @return (gain, loss): the cost decrease of a receiver and the cost increase of a donor,
+                -inf where the tap cannot receive (k = kmax), +inf where it cannot give (k = 0)
+        '''
+        kmax = costTable.shape[1] - 1
+        taps = np.arange(len(self.h))
+        k = self.assgn.astype(np.int64) if k is None else np.asarray(k)
+        current = costTable[taps, np.minimum(k, kmax)]
+        gain = np.where(k < kmax, current - costTable[taps, np.minimum(k + 1, kmax)], -np.inf)
+        loss = np.where(k > 0, costTable[taps, np.maximum(k - 1, 0)] - current, np.inf)
+        return gain, loss
+
+    def terms(self, tap):
+        '''!
+        @brief Signed power-of-two terms of the tap TAP, as in NonUniformSparseAssignment._hRep
+        '''
+        return ExponentsToTerms(self.rep[tap:tap + 1])[0]
+
+    @property
+    def hRep(self):
+        return ExponentsToTerms(self.rep)
+
+    @property
+    def totalCost(self):
+        return float(np.sum(self.cost))
+
+    @property
+    def budget(self):
+        return int(np.sum(self.assgn, dtype=np.int64))
+
+    @property
+    def numCalls(self):
+        return self._numCalls
+
+    @property
+    def nbytes(self):
+        return self.h.nbytes + self.hApp.nbytes + self.assgn.nbytes + self.cost.nbytes + self.rep.nbytes
+
+    def __str__(self):
+        return f'State: {len(self.h)} taps --- Usage: {self.budget} | Cost: {self.totalCost} | Memory: {self.nbytes} B'
+
+class OptimalSparseAssignment(object):
+    '''!
+            Given sparsity budget is distributed across the filter taps with the minimal total cost
+
+    The cost of every tap as a function of its number of shift assignments k is
+    tabulated once, which makes the allocation a multiple-choice knapsack problem.
+    It is solved exactly by dynamic programming over the taps, vectorized over
+    the budget: totalCost[t][b] = min_k totalCost[t-1][b-k] + cost[t][k].
+    '''
+    def __init__(self, hCoeffs, cache=None):
+        ## Exact Filter Coefficients
+        self.h = np.asarray(hCoeffs, dtype=np.float64)
+        ## Representation cache shared with the other assignment objects
+        self.cache = cache if cache is not None else GetRepresentationCache()
+        ## Approximate Filter Coefficients
+        self._hApp = np.zeros(len(self.h), dtype=np.int64)
+        ## Sparse Representation of the Filter Coefficients
+        self._hRep = [[] for _ in self.h]
+        ## Number of shift assignements of every tap
+        self.assgn = np.zeros(len(self.h), dtype=np.int64)
+        ## Minimal total cost for every budget 0 .. sparseBudget
+        self.budgetCost = None
+        ## Number of calls for optimization
+        self._numCalls = 0
+
+    @staticmethod
+    def RequiredBitSetSize(hCoeffs, numBits=6):
+        '''!
+        @brief Number of assignments beyond which the cost of no tap decreases
+
+        The canonical signed digit weight of a tap, plus one for the carry of the top digit out of the search set
+        '''
+        digits = FIRfilterIntegerCoefficients.CanonicalSignedDigits(hCoeffs, numBits)
+        return int(np.max(np.count_nonzero(digits, axis=1), initial=0)) + 1
+
+    def costTable(self, kmax, numBits=6):
+        '''!
+        @brief Approximation and absolute cost of every tap with at most k = 0 .. KMAX assignments
+
+        @return (hApp, cost, rep): hApp and cost of shape (taps, kmax + 1) and the signed exponents of the
+                representations of shape (taps, kmax + 1, kmax), see SparseRepresentationCache.costTable
+        '''
+        with GetMetrics().timer('costTable'):
+            return self.cache.costTable(self.h, kmax, numBits)
+
+    def __call__(self, sparseBudget, numBits=6, kmax=None):
+        self._numCalls += 1
+        if kmax is None:
+            kmax = self.RequiredBitSetSize(self.h, numBits)
+        kmax = max(0, min(kmax, sparseBudget, numBits + 1))
+        hApp, cost, rep = self.costTable(kmax, numBits)
+
+        budgetCost = np.zeros(sparseBudget + 1)
+        choice = np.zeros((len(self.h), sparseBudget + 1), dtype=np.int8)
+        candidates = np.empty((kmax + 1, sparseBudget + 1))
+        metrics = GetMetrics()
+        with metrics.timer('knapsack'):
+            for t in range(len(self.h)):
+                candidates[:] = np.inf
+                for k in range(kmax + 1):
+                    candidates[k, k:] = budgetCost[:sparseBudget + 1 - k] + cost[t, k]
+                # argmin keeps the smallest k among equal costs
+                choice[t] = np.argmin(candidates, axis=0)
+                budgetCost = candidates[choice[t], np.arange(sparseBudget + 1)]
+        if metrics.enabled:
+            metrics.count('candidatesEvaluated', len(self.h) * (kmax + 1) * (sparseBudget + 1))
+        self.budgetCost = budgetCost
+
+        k = np.zeros(len(self.h), dtype=np.int64)
+        b = sparseBudget
+        for t in reversed(range(len(self.h))):
+            k[t] = choice[t, b]
+            b -= k[t]
+        self._hApp = hApp[np.arange(len(self.h)), k]
+        self._hRep = ExponentsToTerms(rep[np.arange(len(self.h)), k])
+        self.assgn = np.array([len(rep) for rep in self._hRep], dtype=np.int64)
+        return self.totalCost
+
+    @property
+    def cost(self):
+        return np.abs(self.h - self._hApp)
+
+    @property
+    def totalCost(self):
+        return float(np.sum(self.cost))
+
+    @property
+    def numCalls(self):
+        return self._numCalls
+
+    def __str__(self):
+        return f'OSA: {len(self.h)} taps --- Usage: {int(np.sum(self.assgn))} | Cost: {self.totalCost}'
+
+def MinSubsetNearTargetSum(set, n, val, maxBitSetSize, method='exhaustive'):
+    '''!
+    Exhaustive search of the subset of at most MAX_BIT_SET_SIZE elements of SET
+    whose sum is closest to VAL. The assignment classes use the table based
+    SparseRepresentationCache, which gives the same cost for the signed power-of-two set.
+    The subsets are visited by increasing size and in lexicographic order, the first
+    best one is kept and the search stops at the first exact one.
+
+    @param method 'exhaustive' enumerates every subset, 'branch' runs BranchBoundSubsetSum,
+                  which returns the same subset for arbitrary search sets
+    '''
+    if method == 'branch':
+        return BranchBoundSubsetSum(set, n, val, maxBitSetSize)
+    if method != 'exhaustive':
+        raise ValueError(f'Unknown method: {method}')
     count = 0
     minSubSet = []
     # identify the shift combinations in the sparse form
-    foundFlag = 0
-    costVal = np.Inf
+    costVal = np.inf
     for r in range(maxBitSetSize+1):
         sparseSet = it.combinations(range(n), r)
-        mIdx = []
         for bits in sparseSet:
+            count += 1
             subSet = [set[i] for i in bits]
             if (costVal > np.abs(sum(subSet)-val)):
                 costVal = np.abs(sum(subSet)-val)
                 minSubSet = subSet
+                if costVal == 0:
+                    # nothing beats an exact subset
+                    break
         if costVal==0:
-            return minSubSet
+            break
+    metrics = GetMetrics()
+    if metrics.enabled:
+        metrics.count('subsetSearches')
+        metrics.count('candidatesEvaluated', count)
     return minSubSet
 
+def BranchBoundSubsetSum(set, n, val, maxBitSetSize):
+    '''!
+    Branch-and-bound version of MinSubsetNearTargetSum for arbitrary search sets (custom
+    shift sets, restricted exponents, ...), where no closed form such as the signed digit
+    table applies. The subsets of every size are built index by index in lexicographic
+    order; the m elements still to be picked from set[j:] sum to at least the m smallest and
+    at most the m largest of them, so a branch whose residual VAL - partial sum is farther
+    from that interval than the best cost found so far is pruned with all its subsets. The
+    interval of set[j:] narrows as j grows, so the first suffix out of reach ends its level.
+    Only strictly better subsets replace the best one, so the result is the one of the
+    exhaustive search. The number of subsets evaluated and pruned is counted in the
+    metrics as candidatesEvaluated and candidatesPruned.
+    '''
+    k = min(maxBitSetSize, n)
+    # smallest and largest sum of m elements of set[j:], for every j and m <= k; the search
+    # visits one node at a time, so the bounds are plain lists, which index faster than arrays
+    lo, hi = [], []
+    for j in range(n + 1):
+        suffix = sorted(set[j:n])
+        m = min(k, n - j)
+        lo.append([0] + list(it.accumulate(suffix[:m])) + [0] * (k - m))
+        hi.append([0] + list(it.accumulate(suffix[::-1][:m])) + [0] * (k - m))
+    best = [abs(val), []]
+    visited, pruned = 1, 0
+
+    def search(start, remaining, partial, chosen):
+        nonlocal visited, pruned
+        if remaining == 0:
+            visited += 1
+            cost = abs(sum(set[i] for i in chosen) - val)
+            if best[0] > cost:
+                best[0], best[1] = cost, [set[i] for i in chosen]
+            return
+        target = val - partial
+        for i in range(start, n - remaining + 1):
+            # the sums of set[i:] only shrink with i: once out of reach, all the later branches are too
+            if max(lo[i][remaining] - target, target - hi[i][remaining], 0) >= best[0]:
+                pruned += math.comb(n - i, remaining)
+                return
+            residual = target - set[i]
+            gap = max(lo[i + 1][remaining - 1] - residual, residual - hi[i + 1][remaining - 1], 0)
+            if gap >= best[0]:
+                pruned += math.comb(n - i - 1, remaining - 1)
+                continue
+            search(i + 1, remaining - 1, partial + set[i], chosen + [i])
+            if best[0] == 0:
+                return
+
+    for r in range(1, k + 1):
+        if best[0] == 0:
+            break
+        search(0, r, 0, [])
+    metrics = GetMetrics()
+    if metrics.enabled:
+        metrics.count('subsetSearches')
+        metrics.count('candidatesEvaluated', visited)
+        metrics.count('candidatesPruned', pruned)
+    return best[1]